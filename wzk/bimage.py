@@ -1,9 +1,13 @@
+import os
+import collections
+
 import numpy as np
 from scipy.signal import convolve
+from scipy.ndimage import distance_transform_edt
 from skimage import measure
 from skimage.morphology import flood_fill
 
-from wzk import geometry, np2, printing, trajectory, grid
+from wzk import geometry, np2, printing, trajectory, grid, random2
 
 
 __eps = 1e-9
@@ -124,17 +128,100 @@ def get_sphere_stencil(r: float, voxel_size: float, n_dim: int = 2) -> (np.ndarr
     return inner, outer
 
 
+# Stencil Cache
+# ----------------------------------------------------------------------------------------------------------------------
+__STENCIL_MODES = ("inner", "outer", "union")
+__stencil_cache = collections.OrderedDict()  # LRU, (radius bucket, voxel_size, n_dim, mode) -> stencil
+__stencil_cache_size = 4096
+__stencil_cache_decimals = 9
+__stencil_cache_directory = None
+
+
+def set_stencil_cache(max_size: int = 4096, directory: str = None, decimals: int = 9):
+    """
+    max_size:  number of stencils kept in memory, the least recently used are evicted
+    directory: optional on-disk store, one small .npz per radius bucket, voxel_size and n_dim, so that the cold start
+               for a new voxel size is paid once per machine and not once per process.
+               Stencils are written once when they are computed and loaded only on a miss of the in-memory cache
+    decimals:  radius bucket, the radius is rounded to r / voxel_size with this many decimals.
+               The default is exact in practice, fewer decimals share stencils between close radii
+    """
+    global __stencil_cache_size, __stencil_cache_directory, __stencil_cache_decimals
+    __stencil_cache_size = max_size
+    __stencil_cache_directory = directory
+    __stencil_cache_decimals = decimals
+    clear_stencil_cache()
+
+
+def clear_stencil_cache():
+    __stencil_cache.clear()
+
+
+def __stencil_file(bucket, voxel_size, n_dim):
+    return f"{__stencil_cache_directory}/stencils_{n_dim}d_{voxel_size:.12g}/{bucket}.npz"
+
+
+def __load_stencil_disk(file) -> dict:
+    try:
+        with np.load(file) as npz:
+            return {m: npz[m] for m in __STENCIL_MODES}
+    except FileNotFoundError:
+        return None
+
+
+def __save_stencil_disk(file, stencils: dict):
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    file_tmp = f"{file[:-4]}_{os.getpid()}.tmp.npz"
+    np.savez(file_tmp, **stencils)
+    os.replace(file_tmp, file)
+
+
+def get_sphere_stencil_cached(r: float, voxel_size: float, n_dim: int = 2, mode: str = "union") -> np.ndarray:
+    """
+    Same as get_sphere_stencil, but cached, see set_stencil_cache().
+    The returned stencils are shared and read-only.
+    mode: inner, outer or union (= np.logical_or(inner, outer))
+    """
+    assert mode in __STENCIL_MODES
+    voxel_size = float(voxel_size)
+    bucket = round(float(r) / voxel_size, __stencil_cache_decimals)
+    key = (bucket, voxel_size, n_dim, mode)
+
+    stencil = __stencil_cache.get(key)
+    if stencil is not None:
+        __stencil_cache.move_to_end(key)
+        return stencil
+
+    file = None if __stencil_cache_directory is None else __stencil_file(bucket=bucket, voxel_size=voxel_size,
+                                                                          n_dim=n_dim)
+    stencils = None if file is None else __load_stencil_disk(file=file)
+    if stencils is None:
+        inner, outer = get_sphere_stencil(r=r, voxel_size=voxel_size, n_dim=n_dim)
+        stencils = dict(inner=inner, outer=outer, union=np.logical_or(inner, outer))
+        if file is not None:
+            __save_stencil_disk(file=file, stencils=stencils)
+
+    for m in __STENCIL_MODES:
+        stencils[m].flags.writeable = False
+        __stencil_cache[(bucket, voxel_size, n_dim, m)] = stencils[m]
+    while len(__stencil_cache) > __stencil_cache_size:
+        __stencil_cache.popitem(last=False)
+
+    return stencils[mode]
+
+
 def get_stencil_list(r, n,
                      voxel_size, n_dim):
     if np.size(r) > 1:
         assert np.size(r) == n
         r_unique, stencil_idx = np.unique(r, return_inverse=True)
-        stencil_list = [get_sphere_stencil(r=r_, voxel_size=voxel_size, n_dim=n_dim) for r_ in r_unique]
     else:
-        stencil_list = [get_sphere_stencil(r=r, voxel_size=voxel_size, n_dim=n_dim)]
         stencil_idx = np.zeros(n, dtype=int)
-        r_unique = np.array([r])
+        r_unique = np.array([r]).ravel()
 
+    stencil_list = [(get_sphere_stencil_cached(r=r_, voxel_size=voxel_size, n_dim=n_dim, mode="inner"),
+                     get_sphere_stencil_cached(r=r_, voxel_size=voxel_size, n_dim=n_dim, mode="outer"))
+                    for r_ in r_unique]
     return r_unique, stencil_list, stencil_idx
 
 
@@ -145,7 +232,7 @@ def create_stencil_dict(voxel_size, n_dim):
         printing.progress_bar(i=i, n=n, prefix="create_stencil_dict")
         d = int((r // voxel_size) * 2 + 3)
         if d not in stencil_dict.keys():
-            stencil = np.logical_or(*get_sphere_stencil(r=r, voxel_size=voxel_size, n_dim=n_dim))
+            stencil = get_sphere_stencil_cached(r=r, voxel_size=voxel_size, n_dim=n_dim, mode="union")
             assert d == stencil.shape[0]
             stencil_dict[d] = stencil
     return stencil_dict
@@ -166,7 +253,11 @@ def bimg2surf(img, limits, level=None):
     return verts, faces
 
 
-def mesh2bimg(p, shape, limits, f=None):
+def mesh2bimg(p, shape, limits, f=None, out=None):
+    """
+    Rasterize the closed polygon (2D) or triangle mesh (3D) and fill its inside.
+    If out is given (bool array or PackedBimg of the same shape), the result is or-ed into it and out is returned.
+    """
     img = np.zeros(shape, dtype=int)
 
     voxel_size = grid.limits2voxel_size(shape=shape, limits=limits)
@@ -194,27 +285,83 @@ def mesh2bimg(p, shape, limits, f=None):
     img = flood_fill(img, seed_point=(0,) * img.ndim, connectivity=1, new_value=2)
     img = np.array(img != 2)
 
+    if out is not None:
+        out |= img
+        return out
     return img
 
 
+__scatter_batch_size = 2 ** 22  # number of voxel indices which are computed at once in scatter_stencil()
+
+
+def scatter_stencil(img, idx, stencil):
+    """
+    Paste the same stencil centered at all idx into img, clipped at the border, same as np2.add_small2big for bool.
+    Instead of looping over the spheres, the indices of all occupied stencil cells are computed at once and
+    scattered with one fancy-indexing pass (in batches to bound the memory).
+    img can also be a PackedBimg, then the bits are set directly without unpacking.
+    """
+    shape = np.array(img.shape)
+    offsets = np.array(np.nonzero(stencil)).T - (np.array(stencil.shape) - 1) // 2
+    if len(offsets) == 0 or len(idx) == 0:
+        return
+    strides = np.cumprod(np.concatenate([shape[1:], [1]])[::-1])[::-1]
+    if isinstance(img, PackedBimg):
+        set_flat = img.set_flat
+    else:
+        img_flat = img.reshape(-1)
+        assert np.shares_memory(img_flat, img)
+
+        def set_flat(i):
+            img_flat[i] = True
+
+    # spheres which lie completely inside only need the flat offsets, the others are clipped at the border
+    inside = np.logical_and(idx + offsets.min(axis=0) >= 0, idx + offsets.max(axis=0) < shape).all(axis=-1)
+    offsets_flat = offsets @ strides
+    idx_flat = idx[inside] @ strides
+    idx_border = idx[~inside]
+
+    batch_size = max(1, __scatter_batch_size // max(1, len(offsets)))
+    for b in range(0, len(idx_flat), batch_size):
+        set_flat((idx_flat[b:b+batch_size, np.newaxis] + offsets_flat[np.newaxis, :]).ravel())
+
+    for b in range(0, len(idx_border), batch_size):
+        i = idx_border[b:b+batch_size, np.newaxis, :] + offsets[np.newaxis, :, :]
+        i = i[np.logical_and(i >= 0, i < shape).all(axis=-1)]
+        set_flat(i @ strides)
+
+
 def spheres2bimg(x, r, shape, limits,
-                 stencil_dict=None):
+                 stencil_dict=None, out=None):
+    """
+    Rasterize the spheres into a bimage.
+    If out is given (bool array or PackedBimg of the same shape), the spheres are added to it and out is returned.
+    """
     x = np.atleast_2d(x)
     n, n_dim = x.shape
     assert len(shape) == n_dim
 
     r = np2.scalar2array(r, shape=n)
-    img = np.zeros(shape, dtype=bool)
+    if out is None:
+        img = np.zeros(shape, dtype=bool)
+    else:
+        img = out
+        assert img.shape == tuple(shape)
     voxel_size = grid.limits2voxel_size(shape=shape, limits=limits)
 
-    for i in range(n):
-        j = grid.x2i(x[i], limits=limits, shape=shape)
-        d = int((r[i] // voxel_size) * 2 + 3)
-        if stencil_dict:
-            stencil = stencil_dict[d]
-        else:
-            stencil = np.logical_or(*get_sphere_stencil(r=r[i], voxel_size=voxel_size, n_dim=n_dim))
-        np2.add_small2big(idx=j, small=stencil, big=img)
+    j = grid.x2i(x, limits=limits, shape=shape)
+    if stencil_dict:
+        d = ((r // voxel_size) * 2 + 3).astype(int)
+        d_unique, stencil_idx = np.unique(d, return_inverse=True)
+        stencil_list = [stencil_dict[d_] for d_ in d_unique]
+    else:
+        r_unique, stencil_idx = np.unique(r, return_inverse=True)
+        stencil_list = [get_sphere_stencil_cached(r=r_, voxel_size=voxel_size, n_dim=n_dim, mode="union")
+                        for r_ in r_unique]
+
+    stencil_idx = np.ravel(stencil_idx)
+    for i, stencil in enumerate(stencil_list):
+        scatter_stencil(img=img, idx=j[stencil_idx == i], stencil=stencil)
 
     return img
 
@@ -222,8 +369,280 @@ def spheres2bimg(x, r, shape, limits,
 def add_boxes_img(img, box_list, limits):
     for x in box_list:
         x = geometry.cube(limits=x)[0]
-        img_x = mesh2bimg(p=x, limits=limits, shape=img.shape)
-        img[:] = np.logical_or(img, img_x)
+        mesh2bimg(p=x, limits=limits, shape=img.shape, out=img)
+
+
+# Packed Bimage
+# ----------------------------------------------------------------------------------------------------------------------
+__POPCOUNT8 = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis], axis=1).sum(axis=1).astype(np.uint8)
+
+
+def popcount(a: np.ndarray) -> np.ndarray:
+    """Number of set bits in each element of an uint8 array."""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(a)
+    return __POPCOUNT8[a]
+
+
+class PackedBimg:
+    """
+    Binary image with 8 voxels per byte, packed with np.packbits along the last axis.
+    The padding bits of the last byte are always zero, so the operators and the population count work byte-wise.
+    Indexing along the leading axes stays packed, any other indexing unpacks to a bool array first.
+    """
+
+    def __init__(self, packed, shape):
+        self.packed = np.asarray(packed, dtype=np.uint8)
+        self.shape = tuple(int(s) for s in shape)
+        assert self.packed.shape == self.get_packed_shape(self.shape)
+
+    @staticmethod
+    def get_packed_shape(shape):
+        return tuple(shape[:-1]) + ((shape[-1] + 7) // 8,)
+
+    @classmethod
+    def zeros(cls, shape):
+        return cls(packed=np.zeros(cls.get_packed_shape(shape), dtype=np.uint8), shape=shape)
+
+    @classmethod
+    def from_bimg(cls, img):
+        img = np.asarray(img, dtype=bool)
+        return cls(packed=np.packbits(img, axis=-1), shape=img.shape)
+
+    def to_bimg(self) -> np.ndarray:
+        return np.unpackbits(self.packed, axis=-1, count=self.shape[-1]).view(bool)
+
+    @classmethod
+    def from_compressed(cls, img_cmp, shape, n_dim: int = None):
+        """Inverse of img2compressed(), shape is the shape of the unpacked image(s)."""
+        from wzk import image
+        shape = tuple(shape)
+        packed_shape = cls.get_packed_shape(shape)
+        if np.shape(img_cmp):
+            n_dim = len(shape) - 1 if n_dim is None else n_dim
+            packed = image.compressed2img(img_cmp=img_cmp, shape=packed_shape[-n_dim:], dtype=np.uint8)
+        else:
+            packed = image.compressed2img(img_cmp=img_cmp, shape=packed_shape, dtype=np.uint8)
+        return cls(packed=packed.reshape(packed_shape), shape=shape)
+
+    def img2compressed(self, n_dim: int = None, level: int = 9):
+        """image.img2compressed() on the packed bytes, the last n_dim axes form one image, None -> all."""
+        from wzk import image
+        return image.img2compressed(img=self.packed, n_dim=self.ndim if n_dim is None else n_dim, level=level)
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    @property
+    def size(self) -> int:
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self) -> int:
+        return self.packed.nbytes
+
+    def __repr__(self):
+        return f"PackedBimg(shape={self.shape}, nbytes={self.nbytes})"
+
+    def __array__(self, dtype=None, copy=None):
+        img = self.to_bimg()
+        return img if dtype is None else img.astype(dtype)
+
+    def copy(self):
+        return PackedBimg(packed=self.packed.copy(), shape=self.shape)
+
+    def __other2packed(self, other):
+        if isinstance(other, PackedBimg):
+            assert other.shape == self.shape
+            return other.packed
+        return np.packbits(np.broadcast_to(np.asarray(other, dtype=bool), self.shape), axis=-1)
+
+    def __or__(self, other):
+        return PackedBimg(packed=np.bitwise_or(self.packed, self.__other2packed(other)), shape=self.shape)
+
+    def __and__(self, other):
+        return PackedBimg(packed=np.bitwise_and(self.packed, self.__other2packed(other)), shape=self.shape)
+
+    def __xor__(self, other):
+        return PackedBimg(packed=np.bitwise_xor(self.packed, self.__other2packed(other)), shape=self.shape)
+
+    __ror__ = __or__
+    __rand__ = __and__
+    __rxor__ = __xor__
+
+    def __ior__(self, other):
+        np.bitwise_or(self.packed, self.__other2packed(other), out=self.packed)
+        return self
+
+    def __iand__(self, other):
+        np.bitwise_and(self.packed, self.__other2packed(other), out=self.packed)
+        return self
+
+    def __ixor__(self, other):
+        np.bitwise_xor(self.packed, self.__other2packed(other), out=self.packed)
+        return self
+
+    def __invert__(self):
+        packed = np.invert(self.packed)
+        packed[..., -1] &= np.uint8((0xFF << (-self.shape[-1] % 8)) & 0xFF)  # keep the padding bits zero
+        return PackedBimg(packed=packed, shape=self.shape)
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        if len(key) < self.ndim and all(isinstance(k, (int, np.integer, slice)) for k in key):
+            packed = self.packed[key]
+            return PackedBimg(packed=packed, shape=packed.shape[:-1] + self.shape[-1:])
+        return self.to_bimg()[key]
+
+    def count(self, n_dim: int = None):
+        """Population count, number of occupied voxels in each image formed by the last n_dim axes, None -> all."""
+        c = popcount(self.packed)
+        if n_dim is None or n_dim == self.ndim:
+            return int(c.sum(dtype=np.int64))
+        return c.reshape(self.shape[:-n_dim] + (-1,)).sum(axis=-1, dtype=np.int64)
+
+    def any(self) -> bool:
+        return bool(self.packed.any())
+
+    def nonzero(self) -> tuple:
+        """Same as np.nonzero(self.to_bimg()), but only the occupied bytes are unpacked."""
+        packed = self.packed.reshape(-1)
+        b = np.flatnonzero(packed)
+        r, c = np.nonzero(np.unpackbits(packed[b][:, np.newaxis], axis=1))
+        row, col = np.divmod(b[r], self.packed.shape[-1])
+        return np.unravel_index(row * self.shape[-1] + col * 8 + c, self.shape)
+
+    def set_flat(self, i):
+        """Set the voxels with the flat (C-order) indices i of the unpacked image."""
+        i = np.ravel(i)
+        if self.shape[-1] % 8 == 0:
+            byte, bit = i >> 3, i & 7
+        else:
+            row, col = np.divmod(i, self.shape[-1])
+            byte, bit = row * self.packed.shape[-1] + (col >> 3), col & 7
+        bit = np.right_shift(np.uint8(0x80), bit.astype(np.uint8))
+
+        if self.packed.flags.c_contiguous:
+            np.bitwise_or.at(self.packed.reshape(-1), byte, bit)
+        else:
+            np.bitwise_or.at(self.packed, np.unravel_index(byte, self.packed.shape), bit)
+
+
+# Signed Distance Field
+# ----------------------------------------------------------------------------------------------------------------------
+class SDF:
+    """
+    Signed distance field on the voxel centers of a bimage, positive in free space and negative inside obstacles.
+    d:       distance in world units
+    d_voxel: distance in voxels
+    query(): multilinear interpolation of distance and gradient at arbitrary points,
+             vectorized and allocation-free when out= is given (the work buffers are reused for the same n)
+    """
+
+    def __init__(self, d, limits):
+        self.d = np.ascontiguousarray(d, dtype=float)
+        self.limits = np.asarray(limits, dtype=float)
+        self.shape = np.array(self.d.shape)
+        self.n_dim = self.d.ndim
+        assert np.all(self.shape >= 2)
+        self.voxel_size = grid.limits2voxel_size(shape=self.d.shape, limits=self.limits)
+
+        self.d_flat = self.d.reshape(-1)
+        self.strides = np.cumprod(np.concatenate([self.shape[1:], [1]])[::-1])[::-1].astype(int)
+        self.corners = np.array(list(np.ndindex((2,) * self.n_dim)), dtype=bool)
+        self.corners_flat = self.corners.astype(int) @ self.strides
+        self.u_max = (self.shape - 1).astype(float)
+        self.buffers = {}
+
+    @property
+    def d_voxel(self):
+        return self.d / self.voxel_size
+
+    def get_buffers(self, n):
+        # one row per dimension, ufuncs on contiguous rows with scalar arguments need no temporary buffers
+        if self.buffers.get("n") != n:
+            self.buffers = dict(n=n, u=np.empty((self.n_dim, n)), i=np.empty((self.n_dim, n), dtype=int),
+                                t0=np.empty((self.n_dim, n)), t1=np.empty((self.n_dim, n)),
+                                i_flat=np.empty(n, dtype=int), j_flat=np.empty(n, dtype=int),
+                                v=np.empty(n), w=np.empty(n))
+        return self.buffers
+
+    def query(self, x, out=None, gradient=True):
+        """
+        x:   (n, n_dim) points in world coordinates, points outside the limits are clamped to the grid
+        out: (d, g) preallocated arrays with shapes (n,) and (n, n_dim), or only d with gradient=False
+        returns d (n,) [and g (n, n_dim)]
+        """
+        x = np.asarray(x, dtype=float)
+        n = len(x)
+        b = self.get_buffers(n)
+        if out is None:
+            out = (np.empty(n), np.empty((n, self.n_dim))) if gradient else np.empty(n)
+        d, g = out if gradient else (out, None)
+
+        # continuous index relative to the voxel centers, cell index and weights of the lower / upper corner
+        u, i, t0, t1, i_flat = b["u"], b["i"], b["t0"], b["t1"], b["i_flat"]
+        i_flat[:] = 0
+        for k in range(self.n_dim):
+            np.subtract(x[:, k], self.limits[k, 0], out=u[k])
+            np.divide(u[k], self.voxel_size, out=u[k])
+            np.subtract(u[k], 0.5, out=u[k])
+            np.clip(u[k], 0, self.u_max[k], out=u[k])
+            np.floor(u[k], out=t1[k])
+            np.minimum(t1[k], self.u_max[k] - 1, out=t1[k])
+            np.copyto(i[k], t1[k], casting="unsafe")
+            np.subtract(u[k], t1[k], out=t1[k])
+            np.subtract(1, t1[k], out=t0[k])
+            np.multiply(i[k], self.strides[k], out=b["j_flat"])
+            np.add(i_flat, b["j_flat"], out=i_flat)
+
+        d[:] = 0
+        if gradient:
+            g[:] = 0
+
+        v, w = b["v"], b["w"]
+        for corner, corner_flat in zip(self.corners, self.corners_flat):
+            np.add(i_flat, corner_flat, out=b["j_flat"])
+            np.take(self.d_flat, b["j_flat"], out=v, mode="clip")  # mode="raise" would allocate a temporary
+
+            w[:] = 1
+            for k in range(self.n_dim):
+                np.multiply(w, t1[k] if corner[k] else t0[k], out=w)
+            np.multiply(w, v, out=w)
+            np.add(d, w, out=d)
+
+            if gradient:
+                for k in range(self.n_dim):
+                    np.copyto(w, v) if corner[k] else np.negative(v, out=w)
+                    for kk in range(self.n_dim):
+                        if kk != k:
+                            np.multiply(w, t1[kk] if corner[kk] else t0[kk], out=w)
+                    np.add(g[:, k], w, out=g[:, k])
+
+        if gradient:
+            np.divide(g, self.voxel_size, out=g)
+            return d, g
+        return d
+
+
+def bimg2sdf(img, limits) -> SDF:
+    """
+    Signed Euclidean distance field of a bimage with a linear-time exact EDT (scipy.ndimage, Maurer et al.).
+    The distances are measured between voxel centers and shifted by half a voxel,
+    so that the zero level lies on the boundary between free and occupied voxels.
+    """
+    img = np.asarray(img, dtype=bool)
+    voxel_size = grid.limits2voxel_size(shape=img.shape, limits=limits)
+
+    if not img.any():
+        d = np.full(img.shape, np.linalg.norm(np.diff(limits, axis=-1)))
+    elif img.all():
+        d = np.full(img.shape, -np.linalg.norm(np.diff(limits, axis=-1)))
+    else:
+        d = np.where(img, 0.5 - distance_transform_edt(img), distance_transform_edt(~img) - 0.5) * voxel_size
+
+    return SDF(d=d, limits=limits)
 
 
 # Sampling 
@@ -250,8 +669,57 @@ def sample_bimg_x(img, limits, n, cell_noise=True, replace=True):
     return x
 
 
-def sample_spheres_bimg_x(x, r, shape, limits, n,):
-    img = spheres2bimg(x=x, r=r, shape=shape, limits=limits)
+class BimgSampler:
+    """
+    Repeated sampling from the same bimage, same as sample_bimg_i / sample_bimg_x with replace=True.
+    The flat indices of the occupied voxels and, for weighted sampling, the alias table are computed once,
+    afterwards each draw is O(n) and does not touch the full grid.
+    weights: None (uniform), per voxel of img or per occupied voxel (in flat C-order)
+    """
+
+    def __init__(self, img, limits, weights=None):
+        self.shape = tuple(img.shape)
+        self.n_dim = len(self.shape)
+        self.limits = np.asarray(limits)
+        self.voxel_size = grid.limits2voxel_size(shape=self.shape, limits=self.limits)
+
+        if isinstance(img, PackedBimg):
+            self.i_flat = np.ravel_multi_index(img.nonzero(), self.shape)
+        else:
+            self.i_flat = np.flatnonzero(img)
+
+        self.prob, self.alias = None, None
+        if weights is not None:
+            weights = np.asarray(weights, dtype=float)
+            if weights.shape == self.shape:
+                weights = weights.reshape(-1)[self.i_flat]
+            assert weights.shape == self.i_flat.shape
+            self.prob, self.alias = random2.alias_table(weights)
+
+    def __len__(self):
+        return len(self.i_flat)
+
+    def sample_i_flat(self, n):
+        if self.prob is None:
+            j = np.random.randint(low=0, high=len(self.i_flat), size=n)
+        else:
+            j = random2.sample_alias(prob=self.prob, alias=self.alias, n=n)
+        return self.i_flat[j]
+
+    def sample_i(self, n):
+        return np.array(np.unravel_index(self.sample_i_flat(n=n), self.shape)).T
+
+    def sample_x(self, n, cell_noise=True):
+        i = self.sample_i(n=n)
+        if cell_noise:
+            u = np.random.random((n, self.n_dim))
+        else:
+            u = 0.5
+        return self.limits[:, 0] + (i + u) * self.voxel_size
+
+
+def sample_spheres_bimg_x(x, r, shape, limits, n, stencil_dict=None):
+    img = spheres2bimg(x=x, r=r, shape=shape, limits=limits, stencil_dict=stencil_dict)
     x = sample_bimg_x(img=img, limits=limits, n=n, replace=True)
     return x
 
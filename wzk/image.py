@@ -1,4 +1,6 @@
 import zlib
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 from skimage.io import imread, imsave  # noqa
 
@@ -186,13 +188,25 @@ def sample_from_img(img, range, n, replace=False):   # noqa
 
 
 # Image Compression <-> Decompression
-def img2compressed(img, n_dim: int, level: int = 9):
+def __map_threads(fun, iterable, n_threads: int = 1):
+    # zlib releases the GIL, so threads are enough to compress / decompress in parallel,
+    # a private executor per call, so it can not block / be closed by another user of a shared pool
+    if n_threads > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            return list(executor.map(fun, iterable))
+    else:
+        return list(map(fun, iterable))
+
+
+def img2compressed(img, n_dim: int, level: int = 9, n_threads: int = 1, container: bool = False):
     """
     Compress the given image with the zlib routine to a binary string.
     Level of compression can be adjusted. A timing with respect to different compression levels for decompression showed
     no difference, so the highest level is default, this corresponds to the largest compression.
     For compression, it is slightly slower but this happens just once and not during keras training, so the smaller
     needed memory was favoured.
+    Multiple images are compressed with n_threads and returned as object array of bytes,
+    or as CompressedImgs container if container=True.
 
     Alternative:
     <-> use numpy sparse for the world images, especially in 3d  -> zlib is more effective and more general
@@ -203,15 +217,22 @@ def img2compressed(img, n_dim: int, level: int = 9):
         return zlib.compress(img.tobytes(), level=level)
 
     else:
+        idx_list = list(np.ndindex(*shape))
+        img_cmp_list = __map_threads(lambda idx: zlib.compress(np.ascontiguousarray(img[idx]), level=level),
+                                     idx_list, n_threads=n_threads)
+        if container:
+            return CompressedImgs.from_list(img_cmp=img_cmp_list, img_shape=img.shape[-n_dim:], dtype=img.dtype)
+
         img_cmp = np.empty(shape, dtype=object)
-        for idx in np.ndindex(*shape):
-            img_cmp[idx] = zlib.compress(img[idx, ...].tobytes(), level=level)
+        for idx, b in zip(idx_list, img_cmp_list):
+            img_cmp[idx] = b
         return img_cmp
 
 
-def compressed2img(img_cmp, shape, n_dim=None, n_channels=None, dtype=None):
+def compressed2img(img_cmp, shape, n_dim=None, n_channels=None, dtype=None, n_threads: int = 1):
     """
     Decompress the binary string back to an array of given shape
+    img_cmp can be a single binary string, an object array of them or a CompressedImgs container.
     """
 
     shape2 = image_array_shape(shape=shape, n_dim=n_dim, n_channels=n_channels)
@@ -219,9 +240,77 @@ def compressed2img(img_cmp, shape, n_dim=None, n_channels=None, dtype=None):
         n_samples = np.size(img_cmp)
         img_arr = initialize_image_array(shape=shape, n_dim=n_dim, n_samples=n_samples, n_channels=n_channels,
                                          dtype=dtype)
-        for i in range(n_samples):
+
+        def decompress(i):
             img_arr[i, ...] = np.frombuffer(zlib.decompress(img_cmp[i]), dtype=dtype).reshape(shape2)
+
+        __map_threads(decompress, range(n_samples), n_threads=n_threads)
         return img_arr
 
     else:
         return np.frombuffer(zlib.decompress(img_cmp), dtype=dtype).reshape(shape2)
+
+
+class CompressedImgs:
+    """
+    Compressed images in one contiguous byte buffer plus an offsets array, instead of an object array of bytes.
+    Indexing returns the compressed bytes of a sample, like the object array, so it works with compressed2img().
+    tobytes() / frombuffer() store all samples in a single sql2 BLOB, save() / load() in a memory-mapped file.
+    decompress(i) decompresses single samples lazily.
+    """
+
+    def __init__(self, buffer, offsets, img_shape=None, dtype=None):
+        self.buffer = buffer  # uint8 array or np.memmap
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.img_shape = None if img_shape is None else tuple(img_shape)
+        self.dtype = None if dtype is None else np.dtype(dtype)
+
+    @classmethod
+    def from_list(cls, img_cmp, img_shape=None, dtype=None):
+        img_cmp = list(np.ravel(img_cmp))
+        offsets = np.zeros(len(img_cmp) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(b) for b in img_cmp])
+        buffer = np.frombuffer(b"".join(img_cmp), dtype=np.uint8)
+        return cls(buffer=buffer, offsets=offsets, img_shape=img_shape, dtype=dtype)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def shape(self):
+        return (len(self),)
+
+    @property
+    def size(self):
+        return len(self)
+
+    def __getitem__(self, i):
+        return self.buffer[self.offsets[i]:self.offsets[i+1]]
+
+    def decompress(self, i):
+        return np.frombuffer(zlib.decompress(self[i]), dtype=self.dtype).reshape(self.img_shape)
+
+    def tobytes(self) -> bytes:
+        """Layout: n_samples (int64) | offsets (int64, n_samples+1) | buffer"""
+        return np.int64(len(self)).tobytes() + self.offsets.tobytes() + np.asarray(self.buffer).tobytes()
+
+    @classmethod
+    def frombuffer(cls, b, img_shape=None, dtype=None):
+        """Inverse of tobytes(), no copy: works with bytes (sql2 BLOB), memoryview or np.memmap."""
+        n = int(np.frombuffer(b, dtype=np.int64, count=1)[0])
+        offsets = np.frombuffer(b, dtype=np.int64, count=n+1, offset=8)
+        buffer = np.frombuffer(b, dtype=np.uint8, offset=8 * (n+2))
+        return cls(buffer=buffer, offsets=offsets, img_shape=img_shape, dtype=dtype)
+
+    def save(self, file: str):
+        with open(file, "wb") as f:
+            f.write(self.tobytes())
+
+    @classmethod
+    def load(cls, file: str, img_shape=None, dtype=None, mmap: bool = True):
+        if mmap:
+            b = np.memmap(file, dtype=np.uint8, mode="r")
+        else:
+            with open(file, "rb") as f:
+                b = f.read()
+        return cls.frombuffer(b, img_shape=img_shape, dtype=dtype)
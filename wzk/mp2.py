@@ -1,8 +1,22 @@
-from time import sleep
+import os
+import atexit
+import collections
+import pickle
+from time import perf_counter
 import numpy as np
+import threading
+import traceback
 import multiprocessing
+import multiprocessing.pool
+import multiprocessing.connection
+from multiprocessing import shared_memory, resource_tracker
 from wzk import ltd
 
+try:
+    import cloudpickle  # closures and lambdas can only be sent to persistent workers with cloudpickle
+except ImportError:
+    cloudpickle = None
+
 # Error under Python3.8 /macOS -> AttributeError: Can't pickle local object 'mp_wrapper.<locals>.__fun_wrapper'
 # https://stackoverflow.com/questions/60518386/error-with-module-multiprocessing-under-python3-8
 try:
@@ -26,6 +40,361 @@ def get_n_samples_per_process(n_samples, n_processes):
     return n_samples_per_core, n_samples_per_core_cs
 
 
+def get_chunks(n_samples, n_processes, schedule="static", min_chunk_size=1):
+    """
+    Contiguous (start, stop) chunks of the samples
+        static: n_processes chunks of equal size
+        guided: guided self-scheduling, each chunk is 1/(2*n_processes) of the remaining samples,
+                so the chunks become smaller towards the end and the workers finish at the same time
+    """
+    if schedule == "static":
+        _, n_samples_pp_cs = get_n_samples_per_process(n_samples=n_samples, n_processes=n_processes)
+        return list(zip(n_samples_pp_cs[:-1].tolist(), n_samples_pp_cs[1:].tolist()))
+
+    elif schedule == "guided":
+        chunks = []
+        start = 0
+        while start < n_samples:
+            size = max(min_chunk_size, int(np.ceil((n_samples - start) / (2 * n_processes))))
+            chunks.append((start, min(n_samples, start + size)))
+            start = chunks[-1][1]
+        return chunks
+
+    else:
+        raise ValueError(f"Unknown schedule '{schedule}'")
+
+
+def get_args_chunk(args, start, stop):
+    if len(args) == 0:
+        return ()
+    elif isinstance(args[0], int):
+        return stop - start,
+    else:
+        return tuple(a if isinstance(a, SharedArray) else a[start:stop] for a in args)
+
+
+def split_args(args, n_processes):
+    if len(args) == 0:
+        return [()] * n_processes
+
+    chunks = get_chunks(n_samples=n_samples_from_args(args), n_processes=n_processes)
+    return [get_args_chunk(args=args, start=start, stop=stop) for start, stop in chunks]
+
+
+def n_samples_from_args(args):
+    if len(args) == 1 and isinstance(args[0], int):
+        return args[0]
+    else:
+        return len(args[0])
+
+
+def fun_chunk(fun, args, max_chunk_size=None):
+    if threading.current_thread() is threading.main_thread():  # threads share the random state of the process
+        np.random.seed(None)
+    if len(args) == 0 or max_chunk_size is None:
+        return fun(*args)
+
+    n_chunks = max(1, n_samples_from_args(args) // max_chunk_size)
+    return combine_results([fun(*a) for a in split_args(args=args, n_processes=n_chunks)])
+
+
+# Persistent Pool
+__pool = None
+__pool_enabled = False  # opt-in, set_pool() lets mp_wrapper reuse the pool by default
+__pool_max_tasks_per_child = None
+__thread_pool = None
+
+
+def dumps_fun(fun):
+    """
+    Serialize fun so that it can be sent to the persistent workers, None if this is not possible.
+    cloudpickle is tried first, it serializes local and __main__ functions by value together with their globals.
+    Plain pickle only stores a reference, which does not exist in workers forked before fun was defined.
+    Functions which hold locks, queues or open connections are not picklable at all,
+    for those mp_wrapper falls back to forking new processes.
+    """
+    for p in (cloudpickle, pickle):
+        if p is None:
+            continue
+        try:
+            return p.dumps(fun)
+        except Exception:  # pickle raises all kinds of errors
+            continue
+    return None
+
+
+def set_pool(n_processes: int = None, max_tasks_per_child: int = None):
+    """
+    Start the module-level pool and let all following calls of mp_wrapper with pool=None reuse it, until close_pool().
+    It is started lazily by mp_wrapper with as many processes as requested and restarted with more if necessary.
+    max_tasks_per_child: restart a worker after this many chunks, to limit memory leaks of long-running workers
+
+    Attention: the workers keep the state of the modules from the time they were started.
+    Importable module functions are sent by reference, if they read module globals which the parent changes later
+    (for example a global robot or world), the workers compute with the old values.
+    Call set_pool() again after changing such state, or use pool=False to fork with the current state.
+    """
+    global __pool, __pool_enabled, __pool_max_tasks_per_child
+    close_pool()
+    __pool_enabled = True
+    __pool_max_tasks_per_child = max_tasks_per_child
+    if n_processes is not None:
+        resource_tracker.ensure_running()  # the workers must share it, otherwise they unlink the shared memory on exit
+        __pool = multiprocessing.Pool(processes=n_processes, maxtasksperchild=max_tasks_per_child)
+    return __pool
+
+
+def get_pool(n_processes: int):
+    global __pool_enabled
+    if __pool is None or __pool._processes < n_processes:  # noqa
+        enabled = __pool_enabled  # pool=True for a single call does not enable the pool for the following calls
+        set_pool(n_processes=n_processes, max_tasks_per_child=__pool_max_tasks_per_child)
+        __pool_enabled = enabled
+    return __pool
+
+
+def get_thread_pool(n_threads: int):
+    global __thread_pool
+    if __thread_pool is None or __thread_pool._processes < n_threads:  # noqa
+        if __thread_pool is not None:
+            __thread_pool.close()
+        __thread_pool = multiprocessing.pool.ThreadPool(processes=n_threads)
+    return __thread_pool
+
+
+def close_pool():
+    global __pool, __pool_enabled, __thread_pool
+    __pool_enabled = False
+    if __pool is not None:
+        __pool.terminate()
+        __pool.join()
+        __pool = None
+    if __thread_pool is not None:
+        __thread_pool.close()
+        __thread_pool.join()
+        __thread_pool = None
+
+
+atexit.register(close_pool)
+
+
+# Shared Memory
+class SharedArray:
+    """
+    Numpy array in a multiprocessing.shared_memory block.
+    Pickling only sends the name of the block, so workers get a view of the array instead of a copy.
+    """
+
+    def __init__(self, shape, dtype, name: str = None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        size = max(1, int(np.prod(self.shape)) * self.dtype.itemsize)
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.array = np.ndarray(shape=self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    @classmethod
+    def from_array(cls, a):
+        sa = cls(shape=a.shape, dtype=a.dtype)
+        sa.array[:] = a
+        return sa
+
+    def __getstate__(self):
+        return self.shape, self.dtype, self.shm.name
+
+    def __setstate__(self, state):
+        shape, dtype, name = state
+        self.__init__(shape=shape, dtype=dtype, name=name)
+
+    def close(self):
+        self.array = None
+        try:
+            self.shm.close()
+        except BufferError:  # views of the array are still alive, the block is closed when they are garbage collected
+            pass
+
+    def unlink(self):
+        self.close()
+        self.shm.unlink()
+
+
+def probe_out(fun, args):
+    """
+    Shape and dtype per sample of each output of fun, by calling it on the first sample
+    """
+    if isinstance(args[0], int):
+        res = fun(1)
+    else:
+        res = fun(*[a[:1] for a in args])
+
+    res = res if isinstance(res, tuple) else (res,)
+    if not all(isinstance(r, np.ndarray) and r.ndim >= 1 and len(r) == 1 for r in res):
+        raise ValueError("shared_memory: fun must return arrays which are split along the first dimension")
+    return [(r.shape[1:], r.dtype) for r in res]
+
+
+def __fun_chunk_timed(i, fun, args, start, stop, max_chunk_size, out):
+    """
+    Task for a single chunk, executed by the workers.
+    Returns the index of the chunk, the id of the worker and its busy time to measure the load balance.
+    With shared memory the arguments are views into the shared blocks and the results are written into out.
+    """
+    t = perf_counter()
+    if isinstance(fun, bytes):
+        try:
+            fun = pickle.loads(fun)
+        except Exception as e:  # pickle raises all kinds of errors
+            raise FunLoadError(repr(e)) from None
+    args_i = tuple(a.array[start:stop] if isinstance(a, SharedArray) else a for a in args)
+    res = fun_chunk(fun=fun, args=args_i, max_chunk_size=max_chunk_size)
+
+    if out is not None:
+        for o, r in zip(out, res if isinstance(res, tuple) else (res,)):
+            o.array[start:stop] = r
+        res = None
+
+    return i, (os.getpid(), threading.get_ident()), perf_counter() - t, res
+
+
+def close_shared(task):
+    _, _, args, _, _, _, out = task
+    for a in args + (out or ()):
+        if isinstance(a, SharedArray):
+            a.close()
+
+
+def __fun_chunk_timed_star(task):
+    # the pool unpickles new handles to the shared blocks for each task
+    try:
+        return __fun_chunk_timed(*task)
+    finally:
+        close_shared(task)
+
+
+class RemoteError(Exception):
+    """Exception in a worker process, with the traceback of the worker"""
+
+
+class FunLoadError(Exception):
+    """fun can not be unpickled in a worker of the pool, e.g. it was defined after the pool was started"""
+
+
+def __fork_worker(tasks, counter, queue):
+    try:
+        while True:
+            with counter.get_lock():
+                i = counter.value
+                counter.value += 1
+            if i >= len(tasks):
+                break
+            queue.put(__fun_chunk_timed(*tasks[i]))
+
+    except BaseException as e:
+        try:
+            pickle.dumps(e)
+        except Exception:  # pickle raises all kinds of errors
+            e = RemoteError(repr(e))
+        queue.put((e, traceback.format_exc()))
+
+    finally:
+        if tasks:  # the forked processes inherit the handles to the shared blocks, close them once
+            close_shared(tasks[0])
+
+
+def __imap_tasks(tasks, pool, n_processes):
+    """
+    Yield the results of the tasks as they are finished,
+    the workers take the next task as soon as they are free.
+    An exception in a worker is raised immediately in the parent.
+    """
+    if isinstance(pool, multiprocessing.pool.ThreadPool):  # the threads share the handles to the shared blocks
+        yield from pool.imap_unordered(lambda task: __fun_chunk_timed(*task), tasks)
+        return
+
+    if pool is not None:
+        yield from pool.imap_unordered(__fun_chunk_timed_star, tasks)
+        return
+
+    # the forked processes inherit the tasks and take the index of the next one from a shared counter
+    counter = multiprocessing.Value("i", 0)
+    queue = multiprocessing.Queue()
+    process_list = []
+    for i in range(n_processes):
+        p = multiprocessing.Process(target=__fork_worker, args=(tasks, counter, queue), name=str(i))
+        p.start()
+        process_list.append(p)
+
+    try:
+        n_done = 0
+        sentinels = {p.sentinel: p for p in process_list}
+        while n_done < len(tasks):
+            # block until a result arrives or a process ends, no polling
+            ready = multiprocessing.connection.wait([queue._reader] + list(sentinels))  # noqa
+            if queue._reader in ready:  # noqa
+                res = queue.get()
+                if isinstance(res[0], BaseException):
+                    raise res[0] from RemoteError(res[1])
+                n_done += 1
+                yield res
+
+            else:
+                for s in ready:
+                    p = sentinels.pop(s)
+                    p.join()
+                    if p.exitcode != 0:
+                        raise RuntimeError(f"mp_wrapper: process {p.name} died with exitcode {p.exitcode}")
+                if not sentinels and queue.empty():
+                    raise RuntimeError("mp_wrapper: all processes finished before all chunks were done")
+
+        for p in process_list:
+            p.join()
+
+    finally:
+        for p in process_list:
+            if p.is_alive():
+                p.terminate()
+                p.join()
+
+
+# Backend
+BACKENDS = ["process", "thread", "serial", "auto"]
+__thread_nbytes = 2 ** 26  # 64MB, see get_backend_auto()
+
+
+def releases_gil(fun):
+    """
+    Decorator to mark that fun spends most of its time in code which releases the GIL (NumPy / BLAS, zlib, sqlite),
+    so that backend='auto' runs it in threads
+    """
+    fun.releases_gil = True
+    return fun
+
+
+def set_thread_nbytes(nbytes: int):
+    global __thread_nbytes
+    __thread_nbytes = nbytes
+
+
+def get_backend_auto(fun, args) -> str:
+    """
+    thread  - if fun is marked with @releases_gil (fun.releases_gil=False forces process)
+            - if the array arguments are larger than set_thread_nbytes(), copying them to processes would be expensive
+    process - otherwise, pure Python code needs processes to be parallel
+    """
+    gil = getattr(fun, "releases_gil", None)
+    if gil is not None:
+        return "thread" if gil else "process"
+
+    nbytes = sum(a.nbytes for a in args if isinstance(a, np.ndarray))
+    return "thread" if nbytes > __thread_nbytes else "process"
+
+
+def print_load_balance(busy: dict, wall: float, n_chunks: int):
+    busy = np.array(list(busy.values()))
+    print(f"mp_wrapper: {n_chunks} chunks on {len(busy)} workers | wall time: {wall:.3f}s | "
+          f"busy time per worker: min {busy.min():.3f}s, mean {busy.mean():.3f}s, max {busy.max():.3f}s | "
+          f"imbalance (max / mean): {busy.max() / busy.mean():.3f}")
+
+
 def vectorize(fun, *args, n_dimx=1):
 
     def fun_vec(x_vec):
@@ -40,7 +409,8 @@ def vectorize(fun, *args, n_dimx=1):
 
 
 def mp_wrapper(*args, fun,
-               n_processes=1, max_chunk_size=None, use_loop=False):
+               n_processes=1, max_chunk_size=None, use_loop=False, pool=None, shared_memory=False, out=None,
+               schedule="static", min_chunk_size=1, backend="process", verbose=0):
     """
     Multiprocessing Wrapper for a function with a single argument.
     arg must be an iterative and will be split along its first dimension and fed to the different processes
@@ -52,6 +422,7 @@ def mp_wrapper(*args, fun,
     - The function breaks if the data passed through the pipe is to large
       so make sure that the data size does not exceed ~100Mb per process
       https://stackoverflow.com/questions/31552716/multiprocessing-queue-full
+      Use shared_memory=True for large arrays
 
     - Numpy's random number generator starts with the same seed for each process, so if your calculations depend on
       those random values, all processes will work with the same numbers. Default behaviour is to call
@@ -64,97 +435,155 @@ def mp_wrapper(*args, fun,
       might cause trouble
 
     - max_chunk_size is intended for cases where both a loop + parallelization is needed because of memory limitations
-    """
 
-    time_sleep = 0.01  # s
+    pool:
+        None  -> reuse the module-level pool if set_pool() was called, else fork n_processes new processes
+        True  -> reuse the module-level pool, it is started if necessary
+        False -> fork n_processes new processes for this call, they see the current state of all modules
+        multiprocessing.Pool -> explicit pool
+        With a pool the workers keep the module state of the time they were started, see set_pool().
+        Falls back to forking if fun is not picklable.
+
+    shared_memory: pass array arguments and results through shared memory instead of pickling them
+    out: shape and dtype per sample of the output ((3,), np.float64), or a list of those for multiple outputs,
+         if None fun is called once on the first sample to determine them
+
+    schedule: how the samples are split, see get_chunks()
+        static -> one chunk per process
+        guided -> many smaller chunks which are handed out as the workers become free,
+                  for samples with heterogeneous cost. The results are still in the original order
+    backend: process, thread, serial or auto, see get_backend_auto()
+        thread -> for workloads which release the GIL, no copies, no pickling, fun can be any closure.
+                  The splitting and combining is the same as with processes
+        serial -> same as use_loop
+    verbose: > 0 prints the busy time per worker
+    """
 
     if len(args) == 0:
         n_samples = n_processes
-    elif len(args) == 1 and isinstance(args[0], int):
-        n_samples = args[0]
-        # args = []
+        schedule = "static"  # fun is called once per process
     else:
-        n_samples = len((args[0]))
+        n_samples = n_samples_from_args(args)
 
     n_processes = n_processes_wrapper(n_processes=n_processes, n_samples=n_samples)
 
     if n_processes == 1:
         return fun(*args)
 
-    if len(args) == 0:
-        def fun_i():
-            np.random.seed(None)
-            return fun()
-
-        def __fun_wrapper(i_process, queue):
-            queue.put((i_process, fun_i()))
-
+    assert backend in BACKENDS
+    backend = get_backend_auto(fun=fun, args=args) if backend == "auto" else backend
+    if use_loop:
+        backend = "serial"
+    elif backend == "process" and multiprocessing.current_process().daemon:  # workers of a pool can't have children
+        backend = "serial"
+
+    chunks = get_chunks(n_samples=n_samples, n_processes=n_processes, schedule=schedule, min_chunk_size=min_chunk_size)
+    if backend == "serial":
+        return combine_results([fun_chunk(fun=fun, args=get_args_chunk(args=args, start=start, stop=stop),
+                                          max_chunk_size=max_chunk_size) for start, stop in chunks])
+
+    if shared_memory:
+        if len(args) == 0:
+            raise ValueError("shared_memory: fun needs arguments which are split along the first dimension")
+        out = probe_out(fun=fun, args=args) if out is None else out
+        out = out if isinstance(out, list) else [out]
+        out = tuple(SharedArray(shape=(n_samples,) + ((shape,) if isinstance(shape, int) else tuple(shape)),
+                                dtype=dtype) for shape, dtype in out)
     else:
-        n_samples_pp, n_samples_pp_cs = \
-            get_n_samples_per_process(n_samples=n_samples, n_processes=n_processes)
-
-        if isinstance(args[0], int):
-            if max_chunk_size is None:
-                def fun_i(i_process):
-                    np.random.seed(None)
-                    return fun(n_samples_pp[i_process])
-
-            else:
-                def fun_i(i_process):
-                    np.random.seed(None)
-                    n_s = n_samples_pp[i_process]
-                    ns_pp, ns_pp_cs = get_n_samples_per_process(n_samples=n_s, n_processes=n_s // max_chunk_size)
-                    return combine_results([fun(ns_pp_i) for ns_pp_i in ns_pp])
-
+        out = None
+
+    t = perf_counter()
+    results = [None] * len(chunks)
+    busy = {}
+    try:
+        for i, pid, t_i, res in imap_chunks(fun, *args, chunks=chunks, n_processes=n_processes, pool=pool,
+                                            max_chunk_size=max_chunk_size, out=out, backend=backend):
+            results[i] = res
+            busy[pid] = busy.get(pid, 0) + t_i
+
+        if out is not None:
+            results = tuple(o.array.copy() for o in out)
+            results = results if len(results) > 1 else results[0]
         else:
-            if max_chunk_size is not None:
-                def fun_i(i_process):
-                    np.random.seed(None)
-                    n_s = n_samples_pp[i_process]
-                    ns_pp, ns_pp_cs = get_n_samples_per_process(n_samples=n_s, n_processes=n_s // max_chunk_size)
-                    return combine_results([fun(*map(lambda a: a[ns_pp_cs[j]:ns_pp_cs[j+1]], args))
-                                            for j in range(len(ns_pp_cs)-1)])
-            else:
-                def fun_i(i_process):
-                    np.random.seed(None)
+            results = combine_results(results=results)
 
-                    return fun(*map(lambda a: a[n_samples_pp_cs[i_process]:n_samples_pp_cs[i_process+1]],
-                                    args))
+    finally:
+        for o in out or ():
+            o.unlink()
 
-        if use_loop:
-            return combine_results([fun_i(i_process=ip) for ip in range(n_processes)])
+    if verbose > 0:
+        print_load_balance(busy=busy, wall=perf_counter() - t, n_chunks=len(chunks))
 
-        def __fun_wrapper(i_process, queue):
-            queue.put((i_process, fun_i(i_process=i_process)))
+    return results
 
-    # Start the processes and save their results in a queue
-    result_queue = multiprocessing.Queue(n_processes)
-    process_list = []
-    for i in range(n_processes):
-        p = multiprocessing.Process(target=__fun_wrapper, args=(i, result_queue), name=str(i))
-        p.start()
-        process_list.append(p)
-
-    # Make sure the queue is full before joining the processes with a small timeout, otherwise there occurred
-    # errors, because a process filled the queue but was still alive
-    while True:
-        sleep(time_sleep)
-        if result_queue.full():
-            break
 
-    # Wait for the processes to finish
-    for i in range(n_processes):
-        process_list[i].join(timeout=time_sleep)
+def imap_chunks(fun, *args, chunks, n_processes, pool=None, max_chunk_size=None, out=None, backend="process"):
+    """
+    Yield (chunk_index, worker, busy_time, result) for each (start, stop) chunk as soon as it is finished.
+    With out (tuple of SharedArray) the results are written into the shared arrays and result is None,
+    the array arguments are then passed through shared memory as well.
+    """
+    if backend == "thread":
+        tasks = [(i, fun, get_args_chunk(args=args, start=start, stop=stop), start, stop, max_chunk_size, out)
+                 for i, (start, stop) in enumerate(chunks)]
+        yield from __imap_tasks(tasks=tasks, pool=get_thread_pool(n_threads=n_processes), n_processes=n_processes)
+        return
+
+    if pool is None:
+        pool = __pool_enabled
+    fun_bytes = None if pool is False else dumps_fun(fun)
+    if fun_bytes is None:
+        pool = None
+    elif pool is True:
+        pool = get_pool(n_processes=n_processes)
+
+    if out is not None and pool is not None:  # forked processes inherit the arguments, only out is shared
+        args = tuple(SharedArray.from_array(a) if isinstance(a, np.ndarray) else a for a in args)
+
+    tasks = [(i, fun if fun_bytes is None else fun_bytes, get_args_chunk(args=args, start=start, stop=stop),
+              start, stop, max_chunk_size, out) for i, (start, stop) in enumerate(chunks)]
+    done = set()
+    try:
+        try:
+            for r in __imap_tasks(tasks=tasks, pool=pool, n_processes=n_processes):
+                done.add(r[0])
+                yield r
+
+        except FunLoadError:  # the forked processes inherit the current state, run the remaining chunks there
+            if pool is None:
+                raise
+            tasks = [(task[0], fun) + task[2:] for task in tasks if task[0] not in done]
+            yield from __imap_tasks(tasks=tasks, pool=None, n_processes=n_processes)
+    finally:
+        for a in args:
+            if isinstance(a, SharedArray):
+                a.unlink()
+
+
+def imap(fun, *args, chunk_size: int, n_processes=1, pool=None, backend="process"):
+    """
+    Iterator over (chunk_index, result), the results are yielded as the chunks are finished, not in order.
+    args are split along the first dimension into chunks of chunk_size, like in mp_wrapper.
+    Downstream work on the first results overlaps with the computation of the rest,
+    an exception in a worker is raised immediately.
 
-    # Combine and return the results
-    results = [result_queue.get() for _ in range(n_processes)]
+    for i, (x, o) in mp2.imap(fun, x, chunk_size=1000, n_processes=8):
+        sql2.set_values(file=file, table=table, values=(x, o), columns=["x", "o"], rows=np.arange(i*1000, ...))
+    """
+    n_samples = n_samples_from_args(args)
+    chunks = [(start, min(n_samples, start + chunk_size)) for start in range(0, n_samples, chunk_size)]
+    n_processes = n_processes_wrapper(n_processes=n_processes, n_samples=len(chunks))
+    backend = get_backend_auto(fun=fun, args=args) if backend == "auto" else backend
+    if backend == "process" and multiprocessing.current_process().daemon:
+        backend = "serial"
 
-    # - order the results according to the process indices
-    results = ltd.change_tuple_order(results)
-    idx = np.argsort(results[0])
-    results = [results[1][i] for i in idx]
+    if n_processes == 1 or backend == "serial":
+        for i, (start, stop) in enumerate(chunks):
+            yield i, fun_chunk(fun=fun, args=get_args_chunk(args=args, start=start, stop=stop))
+        return
 
-    return combine_results(results=results)
+    for i, _, _, res in imap_chunks(fun, *args, chunks=chunks, n_processes=n_processes, pool=pool, backend=backend):
+        yield i, res
 
 
 def combine_results(results):
@@ -167,3 +596,151 @@ def combine_results(results):
             return None
         else:
             return np.concatenate(results, axis=0)
+
+
+# Executor
+class Executor:
+    """
+    Common interface for running many independent tasks locally (PoolExecutor) or on a cluster (ray2.RayExecutor)
+        ref = executor.put(x)                                   # large shared argument, sent to the workers once
+        futures = executor.submit_batch(fun, [(a,) for a in args], x=ref)
+        results = executor.get(futures)
+        for res in executor.map(fun, args_list, max_in_flight=64, x=ref):  # in order, bounded number of tasks
+            ...
+    References returned by put() can be used as positional or keyword arguments, the workers receive the object.
+    """
+
+    n_workers = 1
+    put_nbytes = 2 ** 20  # array keyword arguments larger than this are put() automatically
+
+    def put(self, obj):
+        raise NotImplementedError
+
+    def put_large(self, kwargs: dict) -> dict:
+        return {k: self.put(v) if isinstance(v, np.ndarray) and v.nbytes > self.put_nbytes else v
+                for k, v in kwargs.items()}
+
+    def submit(self, fun, *args, **kwargs):
+        return self.submit_batch(fun, [args], **kwargs)[0]
+
+    def submit_batch(self, fun, args_list, **kwargs) -> list:
+        raise NotImplementedError
+
+    def get(self, futures):
+        raise NotImplementedError
+
+    def map(self, fun, args_list, max_in_flight: int = None, **kwargs):
+        """
+        Yield the results in the order of args_list,
+        at most max_in_flight tasks are submitted at the same time (backpressure)
+        """
+        args_list = iter(args_list)
+        kwargs = self.put_large(kwargs)
+        max_in_flight = self.n_workers * 2 if max_in_flight is None else max_in_flight
+        futures = collections.deque()
+        for args in args_list:
+            if len(futures) >= max_in_flight:
+                yield self.get(futures.popleft())
+            futures.extend(self.submit_batch(fun, [args], **kwargs))
+
+        while futures:
+            yield self.get(futures.popleft())
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ObjectRef:
+    """
+    Reference to an object in shared memory, see PoolExecutor.put().
+    Arrays are viewed directly, other objects are pickled into the block. Each worker loads it only once.
+    """
+
+    def __init__(self, obj):
+        self.is_array = isinstance(obj, np.ndarray)
+        if not self.is_array:
+            obj = np.frombuffer(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL), dtype=np.uint8)
+        self.shared = SharedArray.from_array(obj)
+
+    @property
+    def key(self):
+        return self.shared.shm.name
+
+    def load(self):
+        return self.shared.array if self.is_array else pickle.loads(self.shared.array)
+
+    def unlink(self):
+        self.shared.unlink()
+
+
+__object_cache = {}
+
+
+def resolve_ref(x):
+    if not isinstance(x, ObjectRef):
+        return x
+
+    if x.key not in __object_cache:
+        __object_cache[x.key] = x.load()
+    return __object_cache[x.key]
+
+
+def call_resolved(fun, args, kwargs):
+    fun = pickle.loads(fun) if isinstance(fun, bytes) else fun
+    args = [resolve_ref(a) for a in args]
+    kwargs = {k: resolve_ref(v) for k, v in kwargs.items()}
+    return fun(*args, **kwargs)
+
+
+class PoolExecutor(Executor):
+    """
+    Local Executor on a process (or thread) pool, with the same semantics as ray2.RayExecutor.
+    put() places the object in shared memory, so it is not pickled again for each task.
+    """
+
+    def __init__(self, n_workers: int, backend: str = "process"):
+        assert backend in ("process", "thread")
+        self.n_workers = n_workers
+        self.backend = backend
+        if backend == "process":
+            resource_tracker.ensure_running()
+            self.pool = multiprocessing.Pool(processes=n_workers)
+        else:
+            self.pool = multiprocessing.pool.ThreadPool(processes=n_workers)
+        self.refs = []
+        self.fun_bytes = (None, None)  # map submits the same fun many times, pickle it once
+
+    def put(self, obj):
+        if self.backend == "thread":
+            return obj
+        ref = ObjectRef(obj)
+        self.refs.append(ref)
+        return ref
+
+    def submit_batch(self, fun, args_list, **kwargs) -> list:
+        kwargs = self.put_large(kwargs)
+        if self.backend == "process":
+            if self.fun_bytes[0] is not fun:
+                self.fun_bytes = (fun, dumps_fun(fun))
+            fun = self.fun_bytes[1]
+            if fun is None:
+                raise ValueError("PoolExecutor: fun is not picklable, use backend='thread'")
+        return [self.pool.apply_async(call_resolved, (fun, args, kwargs)) for args in args_list]
+
+    def get(self, futures):
+        if isinstance(futures, (list, tuple)):
+            return [f.get() for f in futures]
+        return futures.get()
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+        for ref in self.refs:
+            ref.unlink()
+        self.refs = []
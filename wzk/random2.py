@@ -158,3 +158,40 @@ def block_shuffle(arr, block_size, inside=False):
         np.random.shuffle(idx_block)
         idx_ele = np2.expand_block_indices(idx_block=idx_block, block_size=block_size, squeeze=True)
         return arr[idx_ele]
+
+
+def alias_table(p):
+    """
+    Walker / Vose alias table for sampling from the discrete distribution p (does not need to be normalized).
+    Instead of pairing one small and one large bin at a time, all small bins are distributed over the large bins
+    at once via their cumulative deficits / excesses, so only a few vectorized passes are needed.
+    Returns (prob, alias), use with sample_alias().
+    """
+    p = np.asarray(p, dtype=float).ravel()
+    m = len(p)
+    assert m > 0 and np.all(p >= 0) and p.sum() > 0
+    prob = p * (m / p.sum())
+    alias = np.arange(m)
+
+    small = np.flatnonzero(prob < 1)
+    large = np.flatnonzero(prob >= 1)
+    while len(small) > 0 and len(large) > 0:
+        deficit = np.cumsum(1 - prob[small])
+        excess = np.cumsum(prob[large] - 1)
+        # total deficit == total excess, clip to the last large bin to absorb rounding errors
+        j = np.minimum(np.searchsorted(excess, deficit, side="left"), len(large) - 1)
+        alias[small] = large[j]
+        prob[large] = np.maximum(prob[large] - np.bincount(j, weights=1 - prob[small], minlength=len(large)), 0)
+
+        small = large[prob[large] < 1]
+        large = large[prob[large] >= 1]
+
+    prob[small] = 1
+    prob[large] = 1
+    return prob, alias
+
+
+def sample_alias(prob, alias, n):
+    """Draw n indices with an alias table from alias_table() in O(n)."""
+    j = np.random.randint(low=0, high=len(prob), size=n)
+    return np.where(np.random.random(n) < prob[j], j, alias[j])
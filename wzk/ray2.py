@@ -5,6 +5,7 @@ import ray
 import fire
 import numpy as np
 
+from wzk import mp2
 from wzk.ltd import squeeze, atleast_list
 from wzk.cpu import ssh_call2, get_n_cpu
 
@@ -131,5 +132,35 @@ def ray_wrapper(fun, n, **kwargs):
     return ray.get(futures)
 
 
+class RayExecutor(mp2.Executor):
+    """
+    Executor on a Ray cluster with the same semantics as mp2.PoolExecutor, see mp2.Executor.
+    put() places large shared arguments in the object store once, every task only gets the reference.
+    map() bounds the number of tasks in flight, so the driver does not submit millions of tasks at once.
+    """
+
+    def __init__(self, n_workers: int = None, perc=100, **remote_kwargs):
+        init(perc=perc)
+        self.n_workers = int(ray.cluster_resources().get("CPU", 1)) if n_workers is None else n_workers
+        self.remote_kwargs = remote_kwargs  # options for ray.remote, e.g. num_cpus=2
+        self.remote_funs = {}
+
+    def put(self, obj):
+        return ray.put(obj)
+
+    def remote(self, fun):
+        if fun not in self.remote_funs:
+            self.remote_funs[fun] = ray.remote(**self.remote_kwargs)(fun) if self.remote_kwargs else ray.remote(fun)
+        return self.remote_funs[fun]
+
+    def submit_batch(self, fun, args_list, **kwargs) -> list:
+        kwargs = self.put_large(kwargs)
+        fun = self.remote(fun)
+        return [fun.remote(*args, **kwargs) for args in args_list]
+
+    def get(self, futures):
+        return ray.get(futures)
+
+
 if __name__ == "__main__":
     fire.Fire(ray_main)
@@ -1,6 +1,15 @@
 from contextlib import contextmanager
 # from threading import Lock  # lock = Lock()
 import os
+import re
+import json
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+import queue as queue_lib
+from time import time
+import traceback
 
 import numpy as np
 import pandas as pd
@@ -8,7 +17,7 @@ from pandas.io import sql  # noqa
 
 import sqlite3
 
-from wzk import ltd, dtypes2, strings, files
+from wzk import ltd, dtypes2, strings, files, hash2
 from wzk.np2 import object2numeric_array, numeric2object_array  # noqa
 from wzk.image import compressed2img, img2compressed  # noqa
 
@@ -45,15 +54,105 @@ def rows2sql(rows: (int, list, np.ndarray), dtype: object = str, values=None) ->
     elif dtype == list:
         return rows.tolist()
 
+    elif dtype == np.ndarray:
+        return rows
+
     else:
         raise ValueError
 
 
+__max_ranges = 256
+__min_rows_json = 1000
+
+
+def rows2ranges(rows: np.ndarray) -> (np.ndarray, np.ndarray):
+    """
+    Merge the sorted unique SQL row ids into contiguous ranges [start, stop] (inclusive).
+    """
+    rows = np.unique(rows)
+    i = np.nonzero(np.diff(rows) != 1)[0]
+    start = rows[np.concatenate([[0], i + 1])]
+    stop = rows[np.concatenate([i, [-1]])]
+    return start, stop
+
+
+def rows2where(rows) -> (str, list):
+    """
+    Encode the row selection as WHERE clause and its parameters, the form is chosen by the density of the rows:
+     - few contiguous ranges (the common case of slices)  ->  ROWID BETWEEN a AND b OR ...
+     - many scattered ids                                 ->  ROWID IN (SELECT value FROM json_each(?))
+     - else                                               ->  ROWID IN (a, b, c, ...)
+    The scattered ids are bound as one JSON parameter, so nothing is written to the connection
+    and concurrent queries on the same persistent Database do not interfere.
+    Together with 'ORDER BY ROWID' all forms return the rows in the order of the table, like 'ROWID in (...)'.
+    """
+    rows = rows2sql(rows, dtype=np.ndarray)
+    if isinstance(rows, int) and rows == -1:
+        return "", []
+
+    if len(rows) == 0:
+        return " WHERE 0", []
+
+    start, stop = rows2ranges(rows)
+    if len(start) <= __max_ranges:
+        ranges = [f"ROWID BETWEEN {a} AND {b}" if a != b else f"ROWID = {a}" for a, b in zip(start, stop)]
+        return f" WHERE {' OR '.join(ranges)}", []
+
+    elif len(rows) >= __min_rows_json:
+        return " WHERE ROWID IN (SELECT value FROM json_each(?))", [json.dumps(np.unique(rows).tolist())]
+
+    else:
+        return f" WHERE ROWID in ({', '.join(map(str, rows.tolist()))})", []
+
+
+def where2sql(where, params=None) -> (str, list):
+    """
+    Predicate which is pushed into the SELECT
+        str:  parameterized SQL fragment, where="world_idx = ? AND n_obstacles > ?", params=(17, 3)
+        dict: equality for each column combined with AND, list values -> IN, where={"world_idx": [17, 18]}
+    """
+    if where is None:
+        return "", []
+
+    elif isinstance(where, str):
+        return where, list(params or [])
+
+    elif isinstance(where, dict):
+        clauses, params = [], []
+        for c, v in where.items():
+            if isinstance(v, (list, tuple, np.ndarray)):
+                v = np.asarray(v).tolist()
+                clauses.append(f"{c} IN ({', '.join(['?'] * len(v))})")
+                params += v
+            else:
+                clauses.append(f"{c} = ?")
+                params.append(v.item() if isinstance(v, np.generic) else v)
+        return " AND ".join(clauses), params
+
+    else:
+        raise ValueError(f"Invalid where '{where}'")
+
+
+def select2sql(table: str, columns, rows=-1, where=None, params=None) -> (str, list):
+    columns_str = columns2sql(columns, dtype=str)
+    where_rows, params_rows = rows2where(rows)
+    where, params = where2sql(where=where, params=params)
+    params = params_rows + params
+    if where:
+        if where_rows:
+            where_rows = f" WHERE ({where_rows[len(' WHERE '):]}) AND ({where})"
+        else:
+            where_rows = f" WHERE {where}"
+
+    return f"SELECT {columns_str} FROM {table}{where_rows} ORDER BY ROWID", params
+
+
 def columns2sql(columns: object, dtype: object):
     if columns is None:
         return "*"
-    if isinstance(columns, str):
+    if isinstance(columns, (str, Col)):
         columns = [columns]
+    columns = [c.name if isinstance(c, Col) else c for c in columns]
 
     if dtype == str:
         return ", ".join(map(str, columns))
@@ -63,6 +162,14 @@ def columns2sql(columns: object, dtype: object):
         raise ValueError
 
 
+def columns2shapes(columns) -> dict:
+    if isinstance(columns, Col):
+        columns = [columns]
+    if columns is None or isinstance(columns, str):
+        return {}
+    return {c.name: c.shape for c in columns if isinstance(c, Col)}
+
+
 def order2sql(order_by, dtype=str):
     if order_by is None:
         order_by_str = ""
@@ -73,7 +180,7 @@ def order2sql(order_by, dtype=str):
             asc_desc = ["ASC"] * len(columns)
 
         elif isinstance(order_by, dict):
-            columns = order_by.keys
+            columns = list(order_by.keys())
             asc_desc = [order_by[k] for k in order_by]
 
         else:
@@ -92,6 +199,192 @@ def order2sql(order_by, dtype=str):
         raise ValueError
     
     
+def file2db(file: str) -> str:
+    file, ext = os.path.splitext(file)
+    return f"{file}{ext or '.db'}"
+
+
+def connect(file: str):
+    check_same_thread = False
+    isolation_level = "DEFERRED"
+
+    try:
+        return sqlite3.connect(database=file, check_same_thread=check_same_thread, isolation_level=isolation_level)
+    except sqlite3.OperationalError as e:
+        print(file)
+        raise e
+
+
+# Persistent Connections
+# ----------------------------------------------------------------------------------------------------------------------
+__database_cache = {}
+default_pragmas = {"journal_mode": "WAL"}
+
+
+class Database:
+    """
+    Persistent handle for a sql file.
+    Holds one connection per process and thread and applies the pragmas once when the connection is opened.
+    While the handle is open (context manager or get_database()) it is registered in a module-level cache
+    keyed by path and pid, so that all free functions called with the same file path reuse its connections.
+    Alternatively a Database can be passed directly as 'file' to every function of this module.
+
+    with sql2.Database(file) as db:
+        for i in range(10000):
+            x = sql2.get_values(file=file, table=table, columns="x", rows=i)  # same as db.get_values(...)
+    """
+
+    def __init__(self, file: str, pragmas: dict = None, vacuum_policy: str = None, vacuum_pages: int = None):
+        self.file = file2db(file)
+        self.pragmas = default_pragmas if pragmas is None else pragmas
+        self.n_open = 0
+        self.cons = {}
+
+        assert vacuum_policy is None or vacuum_policy in VACUUM_POLICIES
+        self.vacuum_policy = vacuum_policy  # None -> module-level policy, see set_vacuum_policy()
+        self.vacuum_pages = vacuum_pages
+        self.vacuum_pending = False
+
+    def __repr__(self):
+        return f"sql2.Database({self.file})"
+
+    def __str__(self):
+        return self.file
+
+    def __fspath__(self):
+        return self.file
+
+    @property
+    def con(self):
+        key = (os.getpid(), threading.get_ident())
+        con = self.cons.get(key)
+        if con is None:
+            con = connect(file=self.file)
+            for k, v in self.pragmas.items():
+                con.execute(f"PRAGMA {k}={v}")
+            self.cons[key] = con
+        return con
+
+    def get_pragma(self, key):
+        if key in self.pragmas:
+            return str(self.pragmas[key]).lower()
+        return str(self.con.execute(f"PRAGMA {key}").fetchone()[0]).lower()
+
+    def open(self):
+        self.n_open += 1
+        set_database(db=self)
+        return self
+
+    def close(self, force: bool = False):
+        self.n_open = 0 if force else max(0, self.n_open - 1)
+        if self.n_open > 0:
+            return
+
+        if self.vacuum_pending:
+            self.vacuum_pending = False
+            vacuum(file=self)
+
+        pid = os.getpid()
+        for key in list(self.cons):
+            con = self.cons.pop(key)
+            if key[0] == pid:  # connections inherited through fork belong to the parent
+                con.close()
+        unset_database(db=self)
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    # API
+    def execute(self, query, lock=None):
+        return execute(file=self, query=query, lock=lock)
+
+    def executemany(self, query, args, lock=None):
+        return executemany(file=self, query=query, args=args, lock=lock)
+
+    def get_tables(self):
+        return get_tables(file=self)
+
+    def get_columns(self, table, mode=None):
+        return get_columns(file=self, table=table, mode=mode)
+
+    def get_n_rows(self, table):
+        return get_n_rows(file=self, table=table)
+
+    def summary(self):
+        return summary(file=self)
+
+    def get_values(self, table, columns=None, rows=-1, **kwargs):
+        return get_values(file=self, table=table, columns=columns, rows=rows, **kwargs)
+
+    def iter_values(self, table, columns=None, rows=-1, chunk_size=10000, squeeze_col=True, where=None, params=None):
+        return iter_values(file=self, table=table, columns=columns, rows=rows, chunk_size=chunk_size,
+                           squeeze_col=squeeze_col, where=where, params=params)
+
+    def get_rows(self, table, where=None, params=None):
+        return get_rows(file=self, table=table, where=where, params=params)
+
+    def create_index(self, table, columns, name=None, unique=False, lock=None):
+        return create_index(file=self, table=table, columns=columns, name=name, unique=unique, lock=lock)
+
+    def explain(self, table, columns=None, rows=-1, where=None, params=None, verbose=1):
+        return explain(file=self, table=table, columns=columns, rows=rows, where=where, params=params,
+                       verbose=verbose)
+
+    def set_values(self, table, values, columns, rows=-1, lock=None):
+        return set_values(file=self, table=table, values=values, columns=columns, rows=rows, lock=lock)
+
+    def append_values(self, table, values, columns=None, batch_size=100000, lock=None):
+        return append_values(file=self, table=table, values=values, columns=columns, batch_size=batch_size,
+                             lock=lock)
+
+    def df2sql(self, df, table, dtype=None, if_exists="fail"):
+        return df2sql(df=df, file=self, table=table, dtype=dtype, if_exists=if_exists)
+
+
+def __database_key(file):
+    return os.path.abspath(str(file)), os.getpid()
+
+
+def set_database(db: Database):
+    __database_cache[__database_key(db)] = db
+
+
+def unset_database(db: Database):
+    key = __database_key(db)
+    if __database_cache.get(key) is db:
+        __database_cache.pop(key)
+
+
+def get_database(file, pragmas: dict = None) -> Database:
+    """
+    Return the open Database for this file and process, open a new one if there is none.
+    The handle stays open until close_databases() is called.
+    """
+    if isinstance(file, Database):
+        return file
+
+    db = __database_cache.get(__database_key(file2db(file)))
+    if db is None:
+        db = Database(file=file, pragmas=pragmas).open()
+    return db
+
+
+def find_database(file):
+    if isinstance(file, Database):
+        return file
+    return __database_cache.get(__database_key(file2db(file)))
+
+
+def close_databases():
+    pid = os.getpid()
+    for key in list(__database_cache):
+        if key[1] == pid:
+            __database_cache[key].close(force=True)
+
+
 @contextmanager
 def open_db_connection(file: str,
                        lock=None,
@@ -99,27 +392,20 @@ def open_db_connection(file: str,
 
     """
     Safety wrapper for the database call.
+    If the file has an open Database handle, its persistent connection is used and never closed here.
     """
-    check_same_thread = False
-    isolation_level = "DEFERRED"
 
     if lock is not None:
         lock.acquire()
 
-    file, ext = os.path.splitext(file)
-    file = f"{file}{ext or '.db'}"
-
-    try:
-        con = sqlite3.connect(database=file, check_same_thread=check_same_thread, isolation_level=isolation_level)
-    except sqlite3.OperationalError as e:
-        print(file)
-        raise e
+    db = find_database(file)
+    con = connect(file=file2db(file)) if db is None else db.con
 
     try:
         yield con
 
     finally:
-        if close:
+        if close and db is None:
             con.close()
         if lock is not None:
             lock.release()
@@ -138,24 +424,77 @@ def execute(file, query, lock=None):
         # con.execute("PRAGMA page_size = 65536")
         con.execute(query)
         __commit(con=con)
+    invalidate_meta(file=file, schema=not is_dml(query))
 
 
 def executemany(file, query, args, lock=None):
     with open_db_connection(file=file, close=True, lock=lock) as con:
         con.executemany(query, args)
         __commit(con=con)
+    invalidate_meta(file=file, schema=not is_dml(query))
 
 
 def executescript(file, query, lock=None):
     with open_db_connection(file=file, close=True, lock=lock) as con:
         con.executescript(query)
         __commit(con=con)
+    invalidate_meta(file=file, schema=True)
+
+
+# Metadata Cache
+# ----------------------------------------------------------------------------------------------------------------------
+# Per file: tables, columns + types, row counts and journal mode.
+# An entry is valid as long as the size and mtime of the file and its -wal file did not change,
+# the functions of this module invalidate it directly after their own writes (DDL -> all, DML -> only row counts).
+__meta_cache = {}
+
+
+def is_dml(query: str) -> bool:
+    return query.lstrip()[:7].upper().startswith(("INSERT", "UPDATE", "DELETE", "REPLACE"))
+
+
+def __file_signature(file: str) -> tuple:
+    signature = []
+    for f in (file, f"{file}-wal"):
+        try:
+            st = os.stat(f)
+            signature.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+
+def get_meta(file) -> dict:
+    file = os.path.abspath(file2db(file))
+    signature = __file_signature(file)
+    meta = __meta_cache.get(file)
+    if meta is None or meta["signature"] != signature:
+        meta = __meta_cache[file] = {"signature": signature, "columns": {}, "n_rows": {}}
+    return meta
+
+
+def invalidate_meta(file, schema: bool = True):
+    file = os.path.abspath(file2db(file))
+    if schema:
+        __meta_cache.pop(file, None)
+
+    elif file in __meta_cache:  # the own write only changed the data
+        meta = __meta_cache[file]
+        meta["n_rows"] = {}
+        meta["signature"] = __file_signature(file)
 
 
 def set_journal_mode_wal(file):
     # https://www.sqlite.org/pragma.html#pragma_journal_mode
     # speed up through smarter journal mode https://sqlite.org/wal.html
-    execute(file=file, query="PRAGMA journal_mode=WAL")
+    if get_meta(file).get("journal_mode") == "wal":
+        return
+    db = find_database(file)
+    if db is None or db.get_pragma("journal_mode") != "wal":
+        with open_db_connection(file=file, close=True, lock=None) as con:
+            con.execute("PRAGMA journal_mode=WAL")
+        invalidate_meta(file=file, schema=False)
+    get_meta(file)["journal_mode"] = "wal"
 
 
 def set_journal_mode_memory(file):
@@ -176,17 +515,111 @@ def vacuum(file):
     execute(file=file, query="VACUUM")
 
 
-def get_tables(file: str) -> list:
+# Vacuum Policy
+#   immediate:   vacuum after each mutation (delete_rows, delete_columns, delete_tables)
+#   deferred:    vacuum once when the Database handle / the deferred_vacuum() context exits
+#   incremental: auto_vacuum=INCREMENTAL and free n pages with incremental_vacuum after each mutation
+VACUUM_POLICIES = ("immediate", "deferred", "incremental")
+__vacuum_policy = {"policy": "immediate", "n_pages": None}
+__vacuum_pending = set()
+
+
+def set_vacuum_policy(policy: str, n_pages: int = None):
+    assert policy in VACUUM_POLICIES, f"policy '{policy}' not in {VACUUM_POLICIES}"
+    __vacuum_policy["policy"] = policy
+    __vacuum_policy["n_pages"] = n_pages
+
+
+def get_vacuum_policy(file) -> (str, int):
+    db = find_database(file)
+    if db is not None and db.vacuum_policy is not None:
+        return db.vacuum_policy, db.vacuum_pages
+    return __vacuum_policy["policy"], __vacuum_policy["n_pages"]
+
+
+def set_auto_vacuum_incremental(file):
+    # https://www.sqlite.org/pragma.html#pragma_auto_vacuum
+    # 0: NONE, 1: FULL, 2: INCREMENTAL, changing it on an existing database requires one full VACUUM
+    with open_db_connection(file=file, close=True, lock=None) as con:
+        auto_vacuum = con.execute("PRAGMA auto_vacuum").fetchone()[0]
+        if auto_vacuum != 2:
+            print(f"vacuum {file}")
+            con.execute("PRAGMA auto_vacuum=INCREMENTAL")  # only applied by a VACUUM on the same connection
+            con.execute(f"PRAGMA temp_store_directory = '{os.path.dirname(file)}'")
+            con.execute("VACUUM")
+    invalidate_meta(file=file)
+
+
+def incremental_vacuum(file, n_pages: int = None):
+    set_auto_vacuum_incremental(file=file)
+    query = "PRAGMA incremental_vacuum" if n_pages is None else f"PRAGMA incremental_vacuum({int(n_pages)})"
     with open_db_connection(file=file, close=True, lock=None) as con:
-        t = pd.read_sql_query(sql="SELECT name FROM sqlite_master WHERE type ='table' AND name NOT LIKE 'sqlite_%'",
-                              con=con)
-    t = t["name"].values
-    return t.tolist()
+        con.execute(query).fetchall()  # the pragma only frees pages while it is stepped
+        __commit(con=con)
+    invalidate_meta(file=file)
+
+
+def request_vacuum(file):
+    """
+    Called by the bulk maintenance functions after they changed the database, acts according to the vacuum policy.
+    """
+    policy, n_pages = get_vacuum_policy(file=file)
+    if policy == "immediate":
+        vacuum(file=file)
+
+    elif policy == "deferred":
+        db = find_database(file)
+        if db is not None and db.vacuum_policy == "deferred":
+            db.vacuum_pending = True
+        else:
+            __vacuum_pending.add(file2db(file))
+
+    elif policy == "incremental":
+        incremental_vacuum(file=file, n_pages=n_pages)
+
+    else:
+        raise ValueError(f"Unknown vacuum policy '{policy}'")
+
+
+def flush_vacuum():
+    while __vacuum_pending:
+        vacuum(file=__vacuum_pending.pop())
+
+
+@contextmanager
+def deferred_vacuum():
+    """
+    Collect all vacuum requests inside the context and vacuum each file only once at the end.
+
+    with sql2.deferred_vacuum():
+        sql2.delete_columns(file=file, table=table, columns="a")
+        sql2.delete_rows(file=file, table=table, rows=rows)
+    """
+    policy_old = __vacuum_policy.copy()
+    set_vacuum_policy(policy="deferred")
+    try:
+        yield
+    finally:
+        set_vacuum_policy(**policy_old)
+        flush_vacuum()
+
+
+def get_tables(file: str) -> list:
+    meta = get_meta(file)
+    if "tables" not in meta:
+        with open_db_connection(file=file, close=True, lock=None) as con:
+            t = pd.read_sql_query(sql="SELECT name FROM sqlite_master WHERE type ='table' AND name NOT LIKE 'sqlite_%'",
+                                  con=con)
+        meta["tables"] = t["name"].values.tolist()
+    return list(meta["tables"])
 
 
 def get_columns(file, table, mode: object = None):
-    with open_db_connection(file=file, close=True, lock=None) as con:
-        c = pd.read_sql_query(con=con, sql=f"pragma table_info({table})")
+    meta = get_meta(file)
+    if table not in meta["columns"]:
+        with open_db_connection(file=file, close=True, lock=None) as con:
+            meta["columns"][table] = pd.read_sql_query(con=con, sql=f"pragma table_info({table})")
+    c = meta["columns"][table].copy()
 
     if mode is None:
         return c
@@ -222,6 +655,46 @@ def summary(file):
         print()
 
 
+def create_index(file, table: str, columns, name: str = None, unique: bool = False, lock=None) -> str:
+    columns = columns2sql(columns, dtype=list)
+    name = f"idx_{table}_{'_'.join(columns)}" if name is None else name
+    unique = "UNIQUE " if unique else ""
+    execute(file=file, query=f"CREATE {unique}INDEX IF NOT EXISTS {name} ON {table}({', '.join(columns)})", lock=lock)
+    return name
+
+
+def drop_index(file, name: str, lock=None):
+    execute(file=file, query=f"DROP INDEX IF EXISTS {name}", lock=lock)
+
+
+def list_indices(file, table: str = None) -> list:
+    query = "SELECT name FROM sqlite_master WHERE type='index' AND name NOT LIKE 'sqlite_%'"
+    params = []
+    if table is not None:
+        query += " AND tbl_name=?"
+        params.append(table)
+    with open_db_connection(file=file, close=True, lock=None) as con:
+        return [n for (n,) in con.execute(query, params).fetchall()]
+
+
+def explain(file, table: str, columns=None, rows=-1, where=None, params=None, verbose=1) -> (list, list):
+    """
+    EXPLAIN QUERY PLAN of the SELECT which get_values would run.
+    Returns the details of the plan and the names of the indices which are used.
+    """
+    with open_db_connection(file=file, close=True, lock=None) as con:
+        query, params = select2sql(table=table, columns=columns, rows=rows, where=where, params=params)
+        plan = con.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall()
+
+    details = [p[-1] for p in plan]
+    indices = [d.split(" INDEX ")[1].split(" ")[0] for d in details if " INDEX " in d]
+    if verbose > 0:
+        print(f"explain file:'{file}' query:'{query}'")
+        for d in details:
+            print(f"\t{d}")
+    return details, indices
+
+
 def rename_tables(file: str, tables: dict) -> None:
     old_names = get_tables(file=file)
     print(f"rename_tables file:'{file}' {tables}")
@@ -231,6 +704,7 @@ def rename_tables(file: str, tables: dict) -> None:
             if old in tables:
                 new = tables[old]
                 cur.execute(f"ALTER TABLE `{old}` RENAME TO `{new}`")
+    invalidate_meta(file=file)
 
 
 def rename_columns(file: str, table: str, columns: dict) -> None:
@@ -242,14 +716,19 @@ def rename_columns(file: str, table: str, columns: dict) -> None:
             if old in old_list:
                 new = columns[old]
                 cur.execute(f"ALTER TABLE `{table}` RENAME COLUMN `{old}` TO `{new}`")
+    invalidate_meta(file=file)
 
 
 def get_n_rows(file, table):
     """
     Only works if the rowid's are [0, ....i_max]
     """
-    with open_db_connection(file=file, close=True, lock=None) as con:
-        return pd.read_sql_query(con=con, sql=f"SELECT COALESCE(MAX(rowid), 0) FROM {table}").values[0, 0]
+    meta = get_meta(file)
+    if table not in meta["n_rows"]:
+        with open_db_connection(file=file, close=True, lock=None) as con:
+            meta["n_rows"][table] = pd.read_sql_query(con=con,
+                                                      sql=f"SELECT COALESCE(MAX(rowid), 0) FROM {table}").values[0, 0]
+    return meta["n_rows"][table]
 
 
 def integrity_check(file):
@@ -273,7 +752,8 @@ def concatenate_tables(file, table, table2=None, file2=None, lock=None):
 
     else:
 
-        query = f"ATTACH DATABASE '{file2}' AS filetwo; INSERT INTO {table} SELECT * FROM filetwo.{table2}"
+        query = (f"ATTACH DATABASE '{file2}' AS filetwo; INSERT INTO {table} SELECT * FROM filetwo.{table2}; "
+                 "DETACH DATABASE filetwo")
         executescript(file=file, query=query, lock=None)
 
 
@@ -283,7 +763,12 @@ def values2bytes(value, column):
     except (ValueError, TypeError, KeyError):
         raise ValueError(f"Error for {column}")
 
-    if np.size(value[0]) > 1 and not isinstance(value[0], bytes) and not isinstance(value[0], str):
+    if ((value.ndim > 1 or np.size(value[0]) > 1) and
+            not isinstance(value[0], bytes) and not isinstance(value[0], str)):
+        if value.dtype != object:
+            # View each row as one fixed-size void scalar, tolist() then creates the bytes in a single pass
+            value = np.ascontiguousarray(value).reshape(len(value), -1)
+            return value.view(np.dtype((np.void, value.shape[1] * value.itemsize)))[:, 0].tolist()
         return [xx.tobytes() for xx in value]
     else:
         return value.tolist()
@@ -296,12 +781,39 @@ def values2bytes_dict(data: dict) -> dict:
     return data
 
 
-def bytes2values(value, column: str):
+def bytes2values(value, column: str, shape=None):
     # SQL saves everything in binary form -> convert back to numeric, expect the columns which are marked as cmp
-    if isinstance(value[0], bytes) and not column.endswith(_CMP):
+    if isinstance(column, Col):
+        column, shape = column.name, column.shape
+
+    if len(value) > 0 and isinstance(value[0], bytes) and not column.endswith(_CMP):
         dtype = dtypes2.str2np(s=column)
-        value = np.array([np.frombuffer(v, dtype=dtype) for v in value])
+        n = len(value)
+        n_bytes = len(value[0])
+        if all(len(v) == n_bytes for v in value):
+            # Equal length -> join all rows into one writable buffer and interpret it as (n, *shape) without copies
+            shape = (-1,) if shape is None else tuple(np.atleast_1d(shape))
+            value = np.frombuffer(bytearray().join(value), dtype=dtype).reshape((n,) + shape)
+
+        else:
+            value_obj = np.empty(n, dtype=object)
+            for i, v in enumerate(value):
+                value_obj[i] = np.frombuffer(v, dtype=dtype)
+            value = value_obj
+
+    return value
 
+
+def sql2values(value: list, column: str, shape=None):
+    # Same conversion as for the columns of the DataFrame returned by pandas.read_sql_query
+    if len(value) > 0 and isinstance(value[0], bytes):
+        if not column.endswith(_CMP):
+            return bytes2values(value=value, column=column, shape=shape)
+        return np.array(value, dtype=object)  # np.array(bytes) would strip trailing zeros
+
+    value = np.array(value)
+    if value.dtype.kind == "U":
+        value = value.astype(object)
     return value
 
 
@@ -313,32 +825,19 @@ def delete_tables(file, tables):
     for t in tables:
         assert t in tables_old, f"table {t} not in {tables_old}"
         execute(file=file, query=f"DROP TABLE {t}")
-    vacuum(file=file)
+    request_vacuum(file=file)
 
 
 def delete_rows(file: str, table: str, rows, lock=None):
-    batch_size = int(1e5)
     print(f"delete_rows 'file':{file} table:'{table}' rows:{rows}")
-    
-    if batch_size is None or batch_size > len(rows):
-        rows = rows2sql(rows, dtype=str)
-        execute(file=file, lock=lock, query=f"DELETE FROM {table} WHERE ROWID in ({rows})")
 
-    else:  # experienced some memory errors
-        assert isinstance(batch_size, int)
-
-        rows = rows2sql(rows, dtype=list)
-        assert isinstance(rows, list)
-        rows = np.array(rows)
-        rows.sort()
-        rows = rows[::-1]
-
-        rows = np.array_split(rows, max(2, int(np.ceil(len(rows)//batch_size))))
-        for r in rows:
-            r = ", ".join(map(str, r.tolist()))
-            execute(file=file, lock=lock, query=f"DELETE FROM {table} WHERE ROWID in ({r})")
+    with open_db_connection(file=file, close=True, lock=lock) as con:
+        where, params = rows2where(rows)
+        con.execute(f"DELETE FROM {table}{where}", params)
+        __commit(con=con)
+    invalidate_meta(file=file, schema=False)
 
-    vacuum(file)
+    request_vacuum(file=file)
 
 
 def delete_columns(file: str, table: str, columns, lock=None):
@@ -348,7 +847,7 @@ def delete_columns(file: str, table: str, columns, lock=None):
     for col in columns:
         if col in old_columns or col == "*":
             execute(file=file, lock=lock, query=f"ALTER TABLE {table} DROP COLUMN {col}")
-    vacuum(file)
+    request_vacuum(file=file)
 
 
 def add_column(file, table, column, dtype, lock=None):
@@ -392,60 +891,170 @@ def sort_table(file, table, order_by):
 
 
 def alter_table(file, table, columns, dtypes, order_by=None):
-    table_tmp = table + strings.uuid4()
-    copy_table(file=file, table_src=table, table_dst=table_tmp, columns=columns, dtypes=dtypes, order_by=order_by)
-    delete_tables(file, tables=table)
-    rename_tables(file, tables={table_tmp: table})
+    if dtypes is not None:
+        columns_cast = get_columns(file=file, table=table, mode="name") if columns is None else columns
+        dtypes = dict(zip(columns2sql(columns_cast, dtype=list), columns2sql(dtypes, dtype=list)))
+    rebuild_table(file=file, table=table, columns=columns, cast=dtypes, order_by=order_by)
 
 
 def squeeze_table(file, table, verbose=1):
-    columns = get_columns(file=file, table=table, mode="name")
-
-    for c in zip(columns):
-        v0 = get_values(file=file, table=table, columns=c, rows=0, return_type="list")
-        if np.size(v0) == 1:
-            if verbose > 0:
-                print(c)
-            v = get_values(file=file, table=table, columns=c, return_type="list")
-            v = np.squeeze(v)
-            set_values(file=file, table=table, values=(v.tolist(),), columns=c)
+    rebuild_table(file=file, table=table, squeeze=True, verbose=verbose)
 
 
 def change_column_dtype(file, table, column, dtype, lock=None):
-    column_tmp = f"{column}{strings.uuid4()}"
-    copy_column(file=file, table=table, column_src=column, column_dst=column_tmp, dtype=dtype)
-    delete_columns(file=file, table=table, columns=column, lock=lock)
-    copy_column(file=file, table=table, column_src=column_tmp, column_dst=column, dtype=dtype)
-    delete_columns(file=file, table=table, columns=column_tmp, lock=lock)
+    rebuild_table(file=file, table=table, cast={column: dtype}, lock=lock)
+
+
+def __get_squeeze_columns(con, table, columns):
+    # Columns whose first non-NULL row is a BLOB with a single element
+    squeeze = {}
+    for c in columns:
+        row = con.execute(f"SELECT {c} FROM {table} WHERE {c} IS NOT NULL LIMIT 1").fetchone()
+        v = None if row is None else row[0]
+        if isinstance(v, bytes) and not c.endswith(_CMP):
+            v = bytes2values(value=[v], column=c)
+            if v.size == 1:
+                squeeze[c] = values2type_sql(v[0, 0])
+    return squeeze
+
+
+def __squeeze_blobs(value, column) -> list:
+    # BLOBs with a single element -> scalars, NULLs are kept
+    j = [i for i, v in enumerate(value) if v is not None]
+    value = list(value)
+    if j:
+        for i, v in zip(j, bytes2values(value=[value[i] for i in j], column=column).reshape(-1).tolist()):
+            value[i] = v
+    return value
+
+
+def index2renamed(query: str, rename: dict) -> str:
+    """
+    Rename the columns in the 'CREATE INDEX name ON table(...)' statement,
+    everything after the first bracket is rewritten, including the WHERE clause of partial indices.
+    """
+    if not rename:
+        return query
+    i = query.index("(")
+    pattern = re.compile(r"\b(" + "|".join(re.escape(c) for c in rename) + r")\b")
+    return query[:i] + pattern.sub(lambda m: rename[m.group(1)], query[i:])
+
+
+def rebuild_table(file, table, columns=None, cast: dict = None, rename: dict = None, drop=None, squeeze=None,
+                  order_by=None, chunk_size: int = 10000, lock=None, verbose=1):
+    """
+    Rewrite the table in a single pass with the given column transforms:
+        columns: new order / subset of the columns (reorder)
+        cast:    {column: dtype} -> CAST(column AS dtype)
+        rename:  {old: new}
+        drop:    [column, ...]
+        squeeze: [column, ...] or True for all columns, BLOBs with a single element per row -> scalar
+        order_by: see order2sql()
+
+    Everything expressible in SQL is done with a single INSERT INTO ... SELECT,
+    python-side transforms (squeeze) are streamed in chunks of rows.
+    The new table replaces the old one inside one transaction and the file is vacuumed once according to the
+    vacuum policy. The indices are recreated with the renamed columns, indices on dropped columns are removed,
+    if any other index can not be recreated, the transaction is rolled back and the error is raised.
+    """
+    cast = {} if cast is None else cast
+    rename = {} if rename is None else rename
+    drop = [] if drop is None else columns2sql(drop, dtype=list)
+
+    names, types = get_columns(file=file, table=table, mode=["name", "type"])
+    types = dict(zip(names, types))
+    columns = list(names) if columns is None else columns2sql(columns, dtype=list)
+    columns = [c for c in columns if c not in drop]
+    assert all(c in types for c in columns), f"{columns} not all in {names}"
+
+    table_tmp = f"{table}{strings.uuid4()}"
+    order_by_str = order2sql(order_by=order_by, dtype=str)
+
+    with open_db_connection(file=file, close=True, lock=lock) as con:
+        if squeeze is True:
+            squeeze = columns
+        squeeze = {} if not squeeze else __get_squeeze_columns(con=con, table=table,
+                                                                columns=columns2sql(squeeze, dtype=list))
+        if verbose > 0 and squeeze:
+            print(f"rebuild_table file:'{file}' table:'{table}' squeeze:{list(squeeze)}")
+
+        dtypes = [cast.get(c, squeeze.get(c, types[c])) for c in columns]
+        columns_dst = [rename.get(c, c) for c in columns]
+        columns_src = [c if (c in squeeze or not d) else f"CAST({c} AS {d})" for c, d in zip(columns, dtypes)]
+
+        indices = []
+        for name, query in con.execute("SELECT name, sql FROM sqlite_master "
+                                       f"WHERE type='index' AND tbl_name='{table}' AND sql IS NOT NULL").fetchall():
+            columns_index = [c for (_, _, c) in con.execute(f"PRAGMA index_info({name})").fetchall()]
+            if any(c is not None and c not in columns for c in columns_index):
+                print(f"rebuild_table: drop index '{name}', its columns {columns_index} are not in {columns}")
+            else:
+                indices.append(index2renamed(query=query, rename=rename))
+
+        con.execute("BEGIN")
+        try:
+            columns_dtype_str = ", ".join([f"{c} {d}" for c, d in zip(columns_dst, dtypes)])
+            con.execute(f"CREATE TABLE {table_tmp}({columns_dtype_str})")
+
+            if not squeeze:
+                con.execute(f"INSERT INTO {table_tmp} SELECT {', '.join(columns_src)} FROM {table}{order_by_str}")
+
+            else:
+                i_squeeze = [i for i, c in enumerate(columns) if c in squeeze]
+                query = f"INSERT INTO {table_tmp} VALUES ({', '.join(['?'] * len(columns))})"
+                cur = con.execute(f"SELECT {', '.join(columns_src)} FROM {table}{order_by_str}")
+                while True:
+                    chunk = cur.fetchmany(chunk_size)
+                    if len(chunk) == 0:
+                        break
+
+                    chunk = list(zip(*chunk))
+                    for i in i_squeeze:
+                        chunk[i] = __squeeze_blobs(value=chunk[i], column=columns[i])
+                    con.executemany(query, zip(*chunk))
+
+            con.execute(f"DROP TABLE {table}")
+            con.execute(f"ALTER TABLE {table_tmp} RENAME TO {table}")
+            for query in indices:
+                con.execute(query)
+            con.commit()
+
+        except BaseException:  # any error, a persistent Database handle would keep the transaction open
+            con.rollback()
+            raise
+
+    invalidate_meta(file=file)
+    request_vacuum(file=file)
 
 
 # Get and Set SQL values
 def get_values(file: str, table: str, columns=None, rows=-1,
-               return_type: str = "list", squeeze_col: bool = True, squeeze_row: bool = True):
+               return_type: str = "list", squeeze_col: bool = True, squeeze_row: bool = True,
+               where=None, params=None):
     """
     'i_samples' == i_samples_global
+    where, params: predicate which is pushed into the SELECT, see where2sql()
+    If a columnar cache is registered for the table (see set_columnar()), the BLOB columns are sliced from
+    its memory maps, contiguous rows are returned as read-only views, copy them before writing.
     """
 
     lock = None  # Lock is not necessary fo reading
 
+    shapes = columns2shapes(columns)
     columns = columns2sql(columns=columns, dtype=list)
-    columns_str = columns2sql(columns=columns, dtype=str)
-
-    rows = rows2sql(rows, dtype=str)
 
-    if rows == -1:  # All samples
-        with open_db_connection(file=file, close=True, lock=lock) as con:
-            df = pd.read_sql_query(con=con, sql=f"SELECT {columns_str} FROM {table}",
-                                   index_col=None, )
+    if return_type == "list" and where is None:
+        value_list = get_values_columnar(file=file, table=table, columns=columns, rows=rows, shapes=shapes)
+        if value_list is not None:
+            return squeeze_value_list(value_list=value_list, squeeze_col=squeeze_col, squeeze_row=squeeze_row)
 
-    else:
-        with open_db_connection(file=file, close=True, lock=lock) as con:
-            try:
-                df = pd.read_sql_query(con=con, sql=f"SELECT {columns_str} FROM {table} WHERE ROWID in ({rows})",
-                                       index_col=None)
-            except pd.io.sql.DatabaseError:
-                print(f"file '{file}' table '{table}'")
-                raise pd.io.sql.DatabaseError
+    with open_db_connection(file=file, close=True, lock=lock) as con:
+        query, params = select2sql(table=table, columns=columns, rows=rows, where=where, params=params)
+        try:
+            df = pd.read_sql_query(con=con, sql=query, params=params, index_col=None)
+        except pd.io.sql.DatabaseError:
+            print(f"file '{file}' table '{table}'")
+            raise pd.io.sql.DatabaseError
 
     value_list = []
     if np.any(columns == "*"):
@@ -454,22 +1063,15 @@ def get_values(file: str, table: str, columns=None, rows=-1,
     if return_type == "list":
         for col in columns:
 
-            value = bytes2values(value=df.loc[:, col].values, column=col)
+            value = bytes2values(value=df.loc[:, col].values, column=col, shape=shapes.get(col))
             value_list.append(value)
 
-        if len(df) == 1 and squeeze_row:
-            for i in range(len(columns)):
-                value_list[i] = value_list[i][0]
-
-        if len(value_list) == 1 and squeeze_col:
-            value_list = value_list[0]
-
-        return value_list
+        return squeeze_value_list(value_list=value_list, squeeze_col=squeeze_col, squeeze_row=squeeze_row)
 
     # Return pandas.DataFrame
     elif return_type == "df" or return_type == "dict":
         for col in columns:
-            value = bytes2values(value=df.loc[:, col].values, column=col)
+            value = bytes2values(value=df.loc[:, col].values, column=col, shape=shapes.get(col))
             try:
                 df.loc[:, col] = value.tolist()
             except ValueError:
@@ -484,6 +1086,67 @@ def get_values(file: str, table: str, columns=None, rows=-1,
         raise ValueError(f"Invalid return_type '{return_type}'")
 
 
+def squeeze_value_list(value_list: list, squeeze_col: bool = True, squeeze_row: bool = True):
+    if len(value_list[0]) == 1 and squeeze_row:
+        for i in range(len(value_list)):
+            value_list[i] = value_list[i][0]
+
+    if len(value_list) == 1 and squeeze_col:
+        value_list = value_list[0]
+
+    return value_list
+
+
+def iter_values(file: str, table: str, columns=None, rows=-1, chunk_size: int = 10000, squeeze_col: bool = True,
+                where=None, params=None):
+    """
+    Generator version of get_values(return_type='list').
+    The rows are pulled with cursor.fetchmany and yielded as decoded numpy chunks,
+    so the peak memory is bounded by one chunk and not by the size of the table.
+
+    for x, y in sql2.iter_values(file=file, table=table, columns=["x_f32", "y_f32"], chunk_size=1000):
+        ...
+    """
+
+    shapes = columns2shapes(columns)
+    columns = columns2sql(columns=columns, dtype=list)
+
+    with open_db_connection(file=file, close=True, lock=None) as con:
+        query, params = select2sql(table=table, columns=columns, rows=rows, where=where, params=params)
+        cur = con.cursor()
+        try:
+            cur.execute(query, params)
+            if np.any(columns == "*"):
+                columns = [d[0] for d in cur.description]
+
+            while True:
+                chunk = cur.fetchmany(chunk_size)
+                if len(chunk) == 0:
+                    break
+
+                value_list = [sql2values(value=list(v), column=c, shape=shapes.get(c))
+                              for v, c in zip(zip(*chunk), columns)]
+                del chunk
+
+                if len(value_list) == 1 and squeeze_col:
+                    value_list = value_list[0]
+
+                yield value_list
+
+        finally:
+            cur.close()
+
+
+def get_rows(file: str, table: str, where=None, params=None) -> np.ndarray:
+    """
+    Indices of the rows which match the predicate, usable as 'rows' for get_values / set_values
+    """
+    with open_db_connection(file=file, close=True, lock=None) as con:
+        query, params = select2sql(table=table, columns="ROWID", where=where, params=params)
+        rows = con.execute(query, params).fetchall()
+    return np.array(rows, dtype=int).reshape(-1) - 1
+
+
 def set_values(file: str, table: str,
                values: tuple, columns, rows=-1, lock=None):
     """
@@ -492,6 +1155,11 @@ def set_values(file: str, table: str,
 
     set_journal_mode_wal(file=file)
 
+    query, values_rows_sql = set_values2sql(table=table, values=values, columns=columns, rows=rows)
+    executemany(file=file, query=query, args=values_rows_sql, lock=lock)
+
+
+def set_values2sql(table: str, values: tuple, columns, rows=-1) -> (str, list):
     rows = rows2sql(rows, values=values[0], dtype=list)
     columns = columns2sql(columns, dtype=list)
     values = tuple(values2bytes(value=v, column=c) for v, c in zip(values, columns))
@@ -502,8 +1170,76 @@ def set_values(file: str, table: str,
     values_rows_sql = ltd.change_tuple_order(values + (rows,))
     values_rows_sql = list(values_rows_sql)
     query = f"UPDATE {table} SET {columns} WHERE ROWID=?"
+    return query, values_rows_sql
+
+
+def values2type_sql(value) -> str:
+    value = np.asarray(value)
+    if value.ndim > 1 or value.dtype == object:
+        return TYPE_BLOB
+    elif value.dtype.kind in "biu":
+        return TYPE_INTEGER
+    elif value.dtype.kind == "f":
+        return TYPE_REAL
+    elif value.dtype.kind in "US":
+        return TYPE_TEXT
+    else:
+        return TYPE_BLOB
 
-    executemany(file=file, query=query, args=values_rows_sql, lock=lock)
+
+def create_table(file, table, columns, dtypes, lock=None):
+    execute(file=file, query=create_table2sql(table=table, columns=columns, dtypes=dtypes), lock=lock)
+
+
+def create_table2sql(table, columns, dtypes) -> str:
+    columns = columns2sql(columns, dtype=list)
+    columns_dtype_str = ", ".join([f"{c} {d}" for c, d in zip(columns, dtypes)])
+    return f"CREATE TABLE IF NOT EXISTS {table}({columns_dtype_str})"
+
+
+def insert2sql(table, columns) -> str:
+    columns = columns2sql(columns, dtype=list)
+    return f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))})"
+
+
+def append_values(file: str, table, values: tuple, columns=None, batch_size: int = 100000, lock=None):
+    """
+    Insert new rows at the end of the table, directly from numpy without going through pandas.
+    values = ([...], [...], [...], ...)
+
+    If the table does not exist yet, it is created from the given columns.
+    'table' can be a sql2.Table and 'columns' a list of sql2.Col to define the SQL types explicitly,
+    otherwise the types are inferred from the values.
+    Each batch is inserted with executemany inside one explicit transaction.
+    """
+    if isinstance(table, Table):
+        columns = table.cols if columns is None else columns
+        table = table.table
+
+    columns = ltd.atleast_list(columns, convert=False)
+    if len(columns) == 1 and not isinstance(values, tuple):
+        values = (values,)
+    assert len(values) == len(columns)
+
+    n = len(values[0])
+    dtypes = [c.type_sql if isinstance(c, Col) else values2type_sql(v) for c, v in zip(columns, values)]
+    columns = columns2sql(columns, dtype=list)
+
+    create_table(file=file, table=table, columns=columns, dtypes=dtypes, lock=lock)
+    set_journal_mode_wal(file=file)
+
+    query = insert2sql(table=table, columns=columns)
+    with open_db_connection(file=file, close=True, lock=lock) as con:
+        for i in range(0, n, batch_size):
+            values_i = [values2bytes(value=v[i:i+batch_size], column=c) for v, c in zip(values, columns)]
+            con.execute("BEGIN")
+            try:
+                con.executemany(query, zip(*values_i))
+                con.commit()
+            except sqlite3.Error as e:
+                con.rollback()
+                raise e
+    invalidate_meta(file=file, schema=False)
 
 
 def df2sql(df, file, table, dtype=None, if_exists="fail"):
@@ -514,7 +1250,8 @@ def df2sql(df, file, table, dtype=None, if_exists="fail"):
                    - replace: If table exists, drop it, recreate it, and insert Measurements.
                    - append: If table exists, insert Measurements. Create if does not exist.
     """
-    file = files.ensure_file_extension(file=file, ext=".db")
+    if not isinstance(file, Database):
+        file = files.ensure_file_extension(file=file, ext=".db")
     if df is None:
         print("No DataFrame was provided...")
         return
@@ -528,6 +1265,7 @@ def df2sql(df, file, table, dtype=None, if_exists="fail"):
     df = pd.DataFrame(data=data)
     with open_db_connection(file=file, close=True, lock=None) as con:
         df.to_sql(name=table, con=con, if_exists=if_exists, index=False, chunksize=None, dtype=dtype)
+    invalidate_meta(file=file)
 
     set_journal_mode_wal(file=file)
 
@@ -570,7 +1308,7 @@ class Table:
         return self.table
 
     def __getitem__(self, item):
-        self.cols.__getitem__(item)
+        return self.cols.__getitem__(item)
 
     def __len__(self):
         return len(self.cols)
@@ -589,3 +1327,540 @@ class Table:
 
     def types_np(self):
         return [c.type_np for c in self.cols]
+
+
+# Batch Loader
+# ----------------------------------------------------------------------------------------------------------------------
+def load_batch(file, table, columns, rows, cmp: dict = None):
+    values = get_values(file=file, table=table, columns=columns, rows=rows, squeeze_col=False, squeeze_row=False)
+    if cmp:
+        for i, c in enumerate(columns2sql(columns, dtype=list)):
+            if c in cmp:
+                values[i] = compressed2img(img_cmp=values[i], **cmp[c])
+
+    return values[0] if len(values) == 1 else values
+
+
+class BatchLoader:
+    """
+    Iterate over the table in batches, the batches are loaded and decoded in the background by n_workers
+    threads (or processes) and at most 'prefetch' batches are kept in memory.
+    Each iteration is one epoch, the rows of each batch are sorted for locality,
+    with 'block_size' > 1 whole blocks of contiguous rows are shuffled, so each batch is made of few rowid ranges.
+    With a seed the batches of each epoch are deterministic (seed, epoch).
+
+    cmp: {column: kwargs for image.compressed2img}, the '_cmp' columns are decompressed in the workers
+
+    loader = sql2.BatchLoader(file=file, table="samples", columns=["q_f32", "img_cmp"], batch_size=64, seed=0,
+                              cmp={"img_cmp": dict(shape=64, n_dim=2, dtype=bool)})
+    for epoch in range(10):
+        for q, img in loader:
+            ...
+    """
+
+    def __init__(self, file, table: str, columns, batch_size: int,
+                 shuffle: bool = True, n_workers: int = 2, prefetch: int = 4, seed: int = None,
+                 rows=None, block_size: int = 1, drop_last: bool = False, cmp: dict = None, backend: str = "thread"):
+
+        assert backend in ("thread", "process")
+        self.file = file if backend == "thread" else str(file)
+        self.table = table
+        self.columns = columns
+        self.batch_size = int(batch_size)
+        self.shuffle = shuffle
+        self.n_workers = max(1, n_workers)
+        self.prefetch = max(1, prefetch)
+        self.seed = seed
+        self.block_size = max(1, block_size)
+        self.drop_last = drop_last
+        self.cmp = cmp
+        self.backend = backend
+
+        rows = np.arange(get_n_rows(file=file, table=table)) if rows is None else rows
+        self.rows = rows2sql(rows, dtype=np.ndarray) - 1
+        self.epoch = 0
+        self.executor = None
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.rows) // self.batch_size
+        return int(np.ceil(len(self.rows) / self.batch_size))
+
+    def get_batches(self, epoch: int) -> list:
+        rows = self.rows
+        if self.shuffle:
+            rng = np.random.default_rng(None if self.seed is None else (self.seed, epoch))
+            n_blocks = int(np.ceil(len(rows) / self.block_size))
+            blocks = [rows[i*self.block_size:(i+1)*self.block_size] for i in rng.permutation(n_blocks)]
+            rows = np.concatenate(blocks) if blocks else rows
+
+        batches = [np.sort(rows[i:i+self.batch_size]) for i in range(0, len(rows), self.batch_size)]
+        return batches[:len(self)]
+
+    def __iter__(self):
+        if self.executor is None:
+            Executor = ThreadPoolExecutor if self.backend == "thread" else ProcessPoolExecutor
+            self.executor = Executor(max_workers=self.n_workers)
+
+        batches = iter(self.get_batches(epoch=self.epoch))
+        self.epoch += 1
+
+        def submit(rows):
+            return self.executor.submit(load_batch, self.file, self.table, self.columns, rows, self.cmp)
+
+        futures = deque(submit(rows) for _, rows in zip(range(self.prefetch), batches))
+        try:
+            while futures:
+                batch = futures.popleft().result()  # errors in the workers are raised here
+                rows = next(batches, None)
+                if rows is not None:
+                    futures.append(submit(rows))
+                yield batch
+
+        finally:
+            for f in futures:
+                f.cancel()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+# Sharded Tables
+# ----------------------------------------------------------------------------------------------------------------------
+def manifest_file(directory: str) -> str:
+    return f"{directory}/manifest.json"
+
+
+class ShardedTable:
+    """
+    One logical table spread over n_shards sql files in a directory, described by a small manifest.json.
+    The shards are interleaved: global row = local row * n_shards + shard.
+    The global rows are stable, appending to any shard does not change the rows of the others,
+    so concurrent writers can append to different shards without a global lock.
+    If the shards have different lengths, not every global row exists, get_rows() returns the existing ones.
+    Reads and writes are fanned out over the shards with a thread pool and reassembled in global order.
+
+    st = sql2.ShardedTable(directory=directory, table="samples", n_shards=8)
+    rows = st.append_values(values=(q, img), columns=["q_f32", "img_cmp"], shard=i_worker)
+    q = st.get_values(columns="q_f32", rows=rows)
+    """
+
+    def __init__(self, directory: str, table: str, n_shards: int = None, n_workers: int = None):
+        self.directory = directory
+        self.table = table
+
+        manifest = manifest_file(directory)
+        if os.path.exists(manifest):
+            manifest = files.load_json(file=manifest)
+            assert manifest["table"] == table, f"{directory} holds table '{manifest['table']}' not '{table}'"
+            assert n_shards is None or n_shards == len(manifest["shards"])
+        else:
+            assert n_shards is not None, f"no manifest in {directory}, n_shards is required to create it"
+            manifest = {"table": table, "shards": [f"shard_{i:04d}.db" for i in range(n_shards)]}
+            files.save_json(obj=manifest, file=manifest_file(directory))
+
+        self.files = [f"{directory}/{f}" for f in manifest["shards"]]
+        self.n_workers = len(self.files) if n_workers is None else max(1, n_workers)
+
+    def __len__(self):
+        return len(self.files)
+
+    def map(self, fun, args: list):
+        if self.n_workers == 1 or len(args) == 1:
+            return [fun(*a) for a in args]
+        with ThreadPoolExecutor(max_workers=min(self.n_workers, len(args))) as executor:
+            return list(executor.map(lambda a: fun(*a), args))
+
+    def get_n_rows_shards(self) -> np.ndarray:
+        def n_rows(f):
+            if not os.path.exists(f) or self.table not in get_tables(file=f):
+                return 0
+            return get_n_rows(file=f, table=self.table)
+
+        return np.array([n_rows(f) for f in self.files], dtype=int)
+
+    def get_n_rows(self) -> int:
+        return int(self.get_n_rows_shards().sum())
+
+    def get_rows(self) -> np.ndarray:
+        n_rows = self.get_n_rows_shards()
+        return np.sort(np.concatenate([np.arange(n) * len(self) + i for i, n in enumerate(n_rows)]))
+
+    def rows2shards(self, rows) -> (np.ndarray, np.ndarray):
+        if isinstance(rows, int) and rows == -1:
+            rows = self.get_rows()
+        rows = rows2sql(rows, dtype=np.ndarray) - 1
+        shards, rows_local = rows % len(self), rows // len(self)
+        n_rows = self.get_n_rows_shards()
+        assert np.all((0 <= rows) & (rows_local < n_rows[shards])), "rows do not exist, see get_rows()"
+        return shards, rows_local
+
+    def get_values(self, columns=None, rows=-1, squeeze_col: bool = True):
+        rows = self.get_rows() if isinstance(rows, int) and rows == -1 else np.unique(rows2sql(rows, np.ndarray) - 1)
+        shards, rows_local = self.rows2shards(rows)
+        i_shards = np.unique(shards)
+
+        values = self.map(lambda f, r: get_values(file=f, table=self.table, columns=columns, rows=r,
+                                                  squeeze_col=False, squeeze_row=False),
+                          [(self.files[i], rows_local[shards == i]) for i in i_shards])
+
+        value_list = []  # the shards are interleaved, put the values of each shard back at its global rows
+        for v_shards in zip(*values):
+            v = np.empty((len(rows),) + v_shards[0].shape[1:], dtype=v_shards[0].dtype)
+            for i, v_i in zip(i_shards, v_shards):
+                v[shards == i] = v_i
+            value_list.append(v)
+
+        if len(value_list) == 1 and squeeze_col:
+            value_list = value_list[0]
+        return value_list
+
+    def set_values(self, values: tuple, columns, rows):
+        shards, rows_local = self.rows2shards(rows)
+        values = tuple(np.asarray(v) for v in values)
+        self.map(lambda f, m: set_values(file=f, table=self.table, values=tuple(v[m] for v in values),
+                                         columns=columns, rows=rows_local[m]),
+                 [(self.files[i], shards == i) for i in np.unique(shards)])
+
+    def append_values(self, values: tuple, columns, shard: int = None, batch_size: int = 100000) -> np.ndarray:
+        """
+        shard=None: distribute the rows round-robin over all shards, shard=i: append everything to shard i
+        Returns the global rows of the appended values.
+        """
+        columns = ltd.atleast_list(columns, convert=False)
+        if len(columns) == 1 and not isinstance(values, tuple):
+            values = (values,)
+        values = tuple(np.asarray(v) for v in values)
+        n_rows = self.get_n_rows_shards()
+
+        if shard is not None:
+            append_values(file=self.files[shard], table=self.table, values=values, columns=columns,
+                          batch_size=batch_size)
+            return (n_rows[shard] + np.arange(len(values[0]))) * len(self) + shard
+
+        self.map(lambda f, i: append_values(file=f, table=self.table, values=tuple(v[i::len(self)] for v in values),
+                                            columns=columns, batch_size=batch_size),
+                 [(f, i) for i, f in enumerate(self.files) if i < len(values[0])])
+
+        rows = np.empty(len(values[0]), dtype=int)
+        for i in range(len(self)):
+            rows[i::len(self)] = (n_rows[i] + np.arange(len(rows[i::len(self)]))) * len(self) + i
+        return rows
+
+
+# Single Writer
+# ----------------------------------------------------------------------------------------------------------------------
+def writer_loop(file, queue, flush_slots, n_errors, condition, max_rows, max_time):
+    """
+    Each message is written in its own savepoint, a failing message is rolled back, printed and counted in n_errors,
+    but it does not stop the writer or the other messages of the transaction.
+    ("flush", slot) commits everything received so far and then acknowledges the slot, see Writer.flush().
+    """
+    pending = []
+    n_rows = 0
+    t_first = None
+
+    def write(con, kind, table, columns, rows, values):
+        if kind == "set":
+            con.executemany(*set_values2sql(table=table, values=values, columns=columns, rows=rows))
+        else:
+            dtypes = [c.type_sql if isinstance(c, Col) else values2type_sql(v) for c, v in zip(columns, values)]
+            con.execute(create_table2sql(table=table, columns=columns, dtypes=dtypes))
+            values = [values2bytes(value=v, column=c) for v, c in zip(values, columns2sql(columns, list))]
+            con.executemany(insert2sql(table=table, columns=columns), zip(*values))
+
+    def commit():
+        if not pending:
+            return
+        n_failed = 0
+        con = db.con
+        try:
+            con.execute("BEGIN")
+            for msg in pending:
+                con.execute("SAVEPOINT msg")
+                try:
+                    write(con, *msg)
+                except Exception:  # a bad message must not kill the writer, flush() would wait forever
+                    con.execute("ROLLBACK TO msg")
+                    traceback.print_exc()
+                    n_failed += 1
+                con.execute("RELEASE msg")
+            con.commit()
+
+        except Exception:
+            con.rollback()
+            traceback.print_exc()
+            n_failed = len(pending)
+
+        if n_failed > 0:
+            with n_errors.get_lock():
+                n_errors.value += n_failed
+        pending.clear()
+
+    with Database(file) as db:
+        while True:
+            timeout = None if t_first is None else max(0., max_time - (time() - t_first))
+            try:
+                msg = queue.get(timeout=timeout)
+            except queue_lib.Empty:
+                msg = ("commit",)
+
+            if msg[0] in ("set", "append"):
+                pending.append(msg)
+                n_rows += len(np.atleast_1d(msg[4][0])) if len(msg[4]) > 0 else 1
+                t_first = time() if t_first is None else t_first
+
+            if msg[0] in ("commit", "flush", "close") or n_rows >= max_rows or time() - t_first >= max_time:
+                commit()
+                n_rows = 0
+                t_first = None
+
+            if msg[0] == "flush":
+                with condition:
+                    abandoned = flush_slots[msg[1]] == Writer.FLUSH_ABANDONED
+                    flush_slots[msg[1]] = Writer.FLUSH_FREE if abandoned else Writer.FLUSH_DONE
+                    condition.notify_all()
+
+            if msg[0] == "close":
+                break
+
+
+class Writer:
+    """
+    Single writer process which owns the connection to the file.
+    Many producers (for example the workers of mp2.mp_wrapper) send their set_values / append_values through a queue,
+    the writer coalesces them and commits one transaction after 'max_rows' rows or 'max_time' seconds.
+    flush() is a barrier, it returns after all messages sent before it by this process are committed.
+    The messages of one process arrive in order, so flush sends a token (a slot in a shared array)
+    which the writer acknowledges after committing everything before it.
+
+    writer = sql2.Writer(file=file)
+    def fun(i):
+        ...
+        writer.set_values(table=table, values=(q,), columns="q_f32", rows=i)
+    mp2.mp_wrapper(np.arange(n), fun=fun, n_processes=32)
+    writer.close()
+    """
+
+    n_flush_slots = 1024
+    FLUSH_FREE, FLUSH_WAIT, FLUSH_DONE, FLUSH_ABANDONED = 0, 1, 2, 3
+
+    def __init__(self, file, max_rows: int = 10000, max_time: float = 1.0, maxsize: int = 0):
+        self.file = str(file)
+        ctx = multiprocessing.get_context()
+        self.queue = ctx.Queue(maxsize=maxsize)
+        self.flush_slots = ctx.Array("b", self.n_flush_slots, lock=False)  # one per pending flush, see flush()
+        self.n_errors = ctx.Value("q", 0)
+        self.condition = ctx.Condition()
+        self.poll_interval = 1.0
+        self.n_errors_raised = 0  # only raise for the errors since the last flush
+        self.pid = os.getpid()  # only the creating process can check if the writer process is alive
+
+        set_journal_mode_wal(file=self.file)
+        self.process = ctx.Process(target=writer_loop, name=f"sql2.Writer({self.file})",
+                                   args=(self.file, self.queue, self.flush_slots, self.n_errors, self.condition,
+                                         max_rows, max_time))
+        self.process.start()
+
+    def put(self, kind, table, columns, rows, values):
+        columns = ltd.atleast_list(columns, convert=False)
+        if len(columns) == 1 and not isinstance(values, tuple):
+            values = (values,)
+        self.queue.put((kind, table, columns, rows, tuple(np.asarray(v) for v in values)))
+
+    def set_values(self, table: str, values: tuple, columns, rows):
+        self.put(kind="set", table=table, columns=columns, rows=rows, values=values)
+
+    def append_values(self, table: str, values: tuple, columns):
+        self.put(kind="append", table=table, columns=columns, rows=None, values=values)
+
+    def flush(self, timeout: float = None):
+        with self.condition:
+            self.condition.wait_for(lambda: self.FLUSH_FREE in self.flush_slots[:])
+            slot = self.flush_slots[:].index(self.FLUSH_FREE)
+            self.flush_slots[slot] = self.FLUSH_WAIT
+        self.queue.put(("flush", slot))
+
+        t = time()
+        try:
+            while True:  # wake up regularly to check that the writer process is still alive
+                with self.condition:
+                    done = self.condition.wait_for(lambda: self.flush_slots[slot] == self.FLUSH_DONE,
+                                                   timeout=self.poll_interval)
+                if done:
+                    break
+                if os.getpid() == self.pid and not self.process.is_alive():
+                    raise RuntimeError(f"sql2.Writer({self.file}): writer process died, "
+                                       f"exitcode {self.process.exitcode}")
+                if timeout is not None and time() - t >= timeout:
+                    raise TimeoutError(f"sql2.Writer({self.file}): flush timed out")
+        finally:  # if the writer did not acknowledge the slot yet, it frees it when it does
+            with self.condition:
+                done = self.flush_slots[slot] == self.FLUSH_DONE
+                self.flush_slots[slot] = self.FLUSH_FREE if done else self.FLUSH_ABANDONED
+                self.condition.notify_all()
+
+        invalidate_meta(file=self.file, schema=True)
+        n_errors = self.n_errors.value - self.n_errors_raised
+        self.n_errors_raised += n_errors
+        if n_errors > 0:
+            raise RuntimeError(f"sql2.Writer({self.file}): {n_errors} messages failed")
+
+    def close(self):
+        if self.process.is_alive():
+            try:
+                self.flush()
+            finally:
+                self.queue.put(("close",))
+                self.process.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+# Columnar Cache
+# ----------------------------------------------------------------------------------------------------------------------
+__columnar_cache = {}
+
+
+def __columnar_signature(file: str) -> list:
+    st = os.stat(file)
+    wal = f"{file}-wal"
+    st_wal = os.stat(wal) if os.path.exists(wal) else None
+    if st_wal is None or st_wal.st_size == 0:  # an empty -wal file is created and removed by every connection
+        return [st.st_size, st.st_mtime_ns, 0, None]
+    return [st.st_size, st.st_mtime_ns, st_wal.st_size, st_wal.st_mtime_ns]
+
+
+def to_columnar(file, table: str, columns=None, directory: str = None, chunk_size: int = 10000,
+                register: bool = True) -> str:
+    """
+    Export the columns of the table to one .npy file per column, which are opened with np.load(mmap_mode="r").
+    The manifest.json records size, mtime and hash of the source file to detect stale caches.
+    If registered, get_values(return_type='list') serves the reads from the cache as long as it is fresh,
+    contiguous rows are zero-copy slices of the memory maps.
+    Only numeric columns are supported, the rowids must be contiguous.
+    """
+    file = file2db(str(file))
+    if directory is None:
+        directory = f"{os.path.splitext(file)[0]}_{table}_columnar"
+
+    with open_db_connection(file=file, close=True, lock=None) as con:
+        con.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        n, n_max = con.execute(f"SELECT COUNT(*), COALESCE(MAX(ROWID), 0) FROM {table}").fetchone()
+    assert n == n_max, f"to_columnar: the rowids of '{table}' must be contiguous, {n} rows but max rowid {n_max}"
+
+    names = columns2sql(columns, dtype=list)
+    if np.any(names == "*"):
+        names = get_columns(file=file, table=table, mode="name").tolist()
+        columns = names
+
+    files.mkdirs(directory)
+    arrays = {}
+    blobs = {}
+    i = 0
+    for chunk in iter_values(file=file, table=table, columns=columns, chunk_size=chunk_size, squeeze_col=False):
+        for c, v in zip(names, chunk):
+            if v.dtype == object:
+                raise ValueError(f"to_columnar: column '{c}' is not numeric / fixed-size")
+            if c not in arrays:
+                arrays[c] = np.lib.format.open_memmap(f"{directory}/{c}.npy", mode="w+", dtype=v.dtype,
+                                                      shape=(n,) + v.shape[1:])
+                blobs[c] = v.ndim > 1
+            arrays[c][i:i + len(v)] = v
+        i += len(chunk[0])
+
+    for a in arrays.values():
+        a.flush()
+    del arrays
+
+    manifest = {"file": os.path.abspath(file), "table": table, "columns": names, "blob": blobs, "n_rows": int(n),
+                "signature": __columnar_signature(file), "hash": str(hash2.hash_file(file))}
+    files.save_json(obj=manifest, file=manifest_file(directory))
+
+    if register:
+        set_columnar(directory=directory)
+    return directory
+
+
+def set_columnar(directory: str):
+    manifest = files.load_json(file=manifest_file(directory))
+    arrays = {c: np.load(f"{directory}/{c}.npy", mmap_mode="r") for c in manifest["blob"]}
+    __columnar_cache[(manifest["file"], manifest["table"])] = {"directory": directory, "manifest": manifest,
+                                                              "arrays": arrays}
+
+
+def unset_columnar(file, table: str):
+    __columnar_cache.pop((os.path.abspath(file2db(str(file))), table), None)
+
+
+def get_columnar(file, table: str) -> dict:
+    """
+    Return the memory maps of the registered cache, None if there is none or if it is stale.
+    The hash is only computed if size or mtime of the file changed,
+    and only once per changed signature, the signature of a failed check is recorded as stale.
+    """
+    file = os.path.abspath(file2db(str(file)))
+    cache = __columnar_cache.get((file, table))
+    if cache is None:
+        return None
+
+    manifest = cache["manifest"]
+    signature = __columnar_signature(file)
+    if signature == manifest["signature"]:
+        return cache["arrays"]
+
+    if signature[2] != 0 or signature == cache.get("signature_stale"):
+        return None
+
+    if str(hash2.hash_file(file)) == manifest["hash"]:
+        manifest["signature"] = signature
+        return cache["arrays"]
+
+    cache["signature_stale"] = signature
+    return None
+
+
+def get_values_columnar(file, table: str, columns, rows, shapes: dict = None) -> list:
+    if not __columnar_cache:
+        return None
+    arrays = get_columnar(file=file, table=table)
+    if arrays is None:
+        return None
+
+    manifest = __columnar_cache[(os.path.abspath(file2db(str(file))), table)]["manifest"]
+    blobs = manifest["blob"]
+    columns = list(blobs) if np.any(columns == "*") else columns
+    if not all(c in arrays for c in columns):
+        return None
+
+    rows = rows2sql(rows, dtype=np.ndarray)
+    if isinstance(rows, int) and rows == -1:
+        idx = slice(None)
+    elif len(rows) == 0 or rows.min() < 1 or rows.max() > manifest["n_rows"]:
+        return None  # empty or out of range, let SQL handle the edge cases
+    else:
+        start, stop = rows2ranges(rows - 1)
+        idx = slice(start[0], stop[0] + 1) if len(start) == 1 else np.unique(rows - 1)
+
+    shapes = {} if shapes is None else shapes
+    value_list = []
+    for c in columns:
+        v = arrays[c][idx]
+        if c in shapes:
+            v = v.reshape((len(v),) + tuple(np.atleast_1d(shapes[c])))
+        elif blobs[c]:
+            v = v.reshape(len(v), -1)
+        value_list.append(v)
+    return value_list
@@ -1,7 +1,7 @@
 import numpy as np
 
 
-from wzk import bimage
+from wzk import bimage, grid
 
 
 def test_get_sphere_stencil():
@@ -49,6 +49,231 @@ def test_spheres2bimg():
     mc2.plot_bimg(p=p, img=img, limits=limits, h=None)
 
 
+def __spheres2bimg_loop(x, r, shape, limits, stencil_dict=None):
+    from wzk import np2, grid
+    r = np2.scalar2array(r, shape=len(x))
+    img = np.zeros(shape, dtype=bool)
+    voxel_size = grid.limits2voxel_size(shape=shape, limits=limits)
+    for i in range(len(x)):
+        j = grid.x2i(x[i], limits=limits, shape=shape)
+        d = int((r[i] // voxel_size) * 2 + 3)
+        if stencil_dict:
+            stencil = stencil_dict[d]
+        else:
+            stencil = np.logical_or(*bimage.get_sphere_stencil(r=r[i], voxel_size=voxel_size, n_dim=len(shape)))
+        np2.add_small2big(idx=j, small=stencil, big=img)
+    return img
+
+
+def test_spheres2bimg_batch():
+    for n_dim, shape in [(2, (64, 64)), (3, (32, 32, 32))]:
+        limits = np.zeros((n_dim, 2))
+        limits[:, 1] = 1
+        x = np.random.uniform(low=-0.1, high=1.1, size=(200, n_dim))  # includes spheres at and beyond the border
+        r = np.random.choice([0.01, 0.05, 0.1, 0.13], size=200)
+        stencil_dict = {int((r_ // (1/shape[0])) * 2 + 3):
+                        np.logical_or(*bimage.get_sphere_stencil(r=r_, voxel_size=1/shape[0], n_dim=n_dim))
+                        for r_ in [0.01, 0.05, 0.07, 0.1, 0.13]}
+
+        for r_ in [r, 0.07]:
+            for sd in [None, stencil_dict]:
+                img = bimage.spheres2bimg(x=x, r=r_, shape=shape, limits=limits, stencil_dict=sd)
+                img_loop = __spheres2bimg_loop(x=x, r=r_, shape=shape, limits=limits, stencil_dict=sd)
+                assert np.array_equal(img, img_loop)
+
+        img = bimage.spheres2bimg(x=x[:1], r=r[:1], shape=shape, limits=limits)
+        assert np.array_equal(img, __spheres2bimg_loop(x=x[:1], r=r[:1], shape=shape, limits=limits))
+
+
+def test_stencil_cache():
+    import os
+    import tempfile
+    bimage.set_stencil_cache(max_size=6)
+
+    r_list, stencil_list, stencil_idx = bimage.get_stencil_list(r=[0.1, 0.2, 0.1], n=3, voxel_size=0.03, n_dim=3)
+    assert np.array_equal(stencil_idx, [0, 1, 0])
+    for r, (inner, outer) in zip(r_list, stencil_list):
+        inner2, outer2 = bimage.get_sphere_stencil(r=r, voxel_size=0.03, n_dim=3)
+        assert np.array_equal(inner, inner2) and np.array_equal(outer, outer2)
+        assert not inner.flags.writeable
+    assert bimage.get_sphere_stencil_cached(r=0.1, voxel_size=0.03, n_dim=3, mode="inner") is stencil_list[0][0]
+
+    bimage.get_sphere_stencil_cached(r=0.3, voxel_size=0.03, n_dim=3)  # evicts the least recently used r=0.2
+    assert bimage.get_sphere_stencil_cached(r=0.1, voxel_size=0.03, n_dim=3, mode="inner") is stencil_list[0][0]
+    assert bimage.get_sphere_stencil_cached(r=0.2, voxel_size=0.03, n_dim=3, mode="inner") is not stencil_list[1][0]
+
+    # new process -> loaded from disk
+    directory = tempfile.mkdtemp()
+    bimage.set_stencil_cache(directory=directory)
+    bimage.spheres2bimg(x=np.random.random((10, 3)), r=0.3, shape=(32, 32, 32), limits=np.array([[0, 0.96]] * 3))
+    bimage.get_sphere_stencil_cached(r=0.2, voxel_size=0.03, n_dim=3)
+    assert len(os.listdir(f"{directory}/stencils_3d_0.03")) == 2  # one file per radius, written once
+    bimage.clear_stencil_cache()
+    get_sphere_stencil = bimage.get_sphere_stencil
+    try:
+        bimage.get_sphere_stencil = None
+        union = bimage.get_sphere_stencil_cached(r=0.3, voxel_size=0.03, n_dim=3)
+    finally:
+        bimage.get_sphere_stencil = get_sphere_stencil
+    assert np.array_equal(union, np.logical_or(*get_sphere_stencil(r=0.3, voxel_size=0.03, n_dim=3)))
+    bimage.set_stencil_cache()
+
+
+def test_packed_bimg():
+    img = np.random.random((3, 17, 21)) < 0.3
+    img2 = np.random.random((3, 17, 21)) < 0.3
+    pimg, pimg2 = bimage.PackedBimg.from_bimg(img), bimage.PackedBimg.from_bimg(img2)
+    assert pimg.nbytes == 3 * 17 * 3
+    assert np.array_equal(pimg.to_bimg(), img)
+
+    assert np.array_equal((pimg | pimg2).to_bimg(), img | img2)
+    assert np.array_equal((pimg & img2).to_bimg(), img & img2)
+    assert np.array_equal((pimg ^ pimg2).to_bimg(), img ^ img2)
+    assert np.array_equal((~pimg).to_bimg(), ~img)
+    assert (~pimg).count() == (~img).sum()
+    assert np.array_equal(pimg.count(n_dim=2), img.sum(axis=(1, 2)))
+    pimg3 = pimg.copy()
+    pimg3 |= img2
+    assert np.array_equal(pimg3.to_bimg(), img | img2)
+
+    assert np.array_equal(pimg[1].to_bimg(), img[1])
+    assert np.array_equal(pimg[1:, 2:5].to_bimg(), img[1:, 2:5])
+    assert np.array_equal(pimg[..., 3], img[..., 3])
+    assert all(np.array_equal(a, b) for a, b in zip(np.nonzero(pimg), np.nonzero(img)))
+    i = bimage.sample_bimg_i(img=pimg, n=100)
+    assert img[tuple(i.T)].all()
+
+    pimg3 = bimage.PackedBimg.from_compressed(img_cmp=pimg.img2compressed(), shape=img.shape)
+    assert np.array_equal(pimg3.to_bimg(), img)
+    pimg3 = bimage.PackedBimg.from_compressed(img_cmp=pimg.img2compressed(n_dim=2), shape=img.shape)
+    assert np.array_equal(pimg3.to_bimg(), img)
+
+    limits = np.array([[0, 1], [0, 1], [0, 30/32]])  # last axis is not a multiple of 8
+    x = np.random.uniform(low=-0.1, high=1.1, size=(50, 3))
+    pimg = bimage.PackedBimg.zeros(shape=(32, 32, 30))
+    bimage.spheres2bimg(x=x, r=0.1, shape=pimg.shape, limits=limits, out=pimg)
+    assert np.array_equal(pimg.to_bimg(), bimage.spheres2bimg(x=x, r=0.1, shape=pimg.shape, limits=limits))
+
+    p = np.random.random((10, 2))
+    pimg = bimage.PackedBimg.zeros(shape=(64, 60))
+    bimage.mesh2bimg(p=p, shape=pimg.shape, limits=limits[1:], out=pimg)
+    assert np.array_equal(pimg.to_bimg(), bimage.mesh2bimg(p=p, shape=pimg.shape, limits=limits[1:]))
+
+
+def test_bimg_sampler():
+    limits = np.array([[0, 1], [0, 2]])
+    img = np.random.random((32, 64)) < 0.1
+    for img_ in [img, bimage.PackedBimg.from_bimg(img)]:
+        sampler = bimage.BimgSampler(img=img_, limits=limits)
+        assert len(sampler) == img.sum()
+        i = sampler.sample_i(n=1000)
+        assert img[tuple(i.T)].all()
+        x = sampler.sample_x(n=1000)
+        assert img[tuple(grid.x2i(x=x, limits=limits, shape=img.shape).T)].all()
+        x = sampler.sample_x(n=10, cell_noise=False)
+        assert np.allclose(x, grid.i2x(i=grid.x2i(x=x, limits=limits, shape=img.shape), limits=limits, shape=img.shape))
+
+    # weighted, half of the samples in the first voxel
+    weights = np.ones(img.shape)
+    i0 = np.array(np.nonzero(img))[:, 0]
+    weights[tuple(i0)] = img.sum() - 1
+    sampler = bimage.BimgSampler(img=img, limits=limits, weights=weights)
+    i = sampler.sample_i(n=100000)
+    assert img[tuple(i.T)].all()
+    assert np.isclose((i == i0).all(axis=-1).mean(), 0.5, atol=0.01)
+
+
+def speed_bimg_sampler():
+    from wzk import tic, toc
+    img = np.random.random((64, 64, 64)) < 0.3
+    limits = np.array([[0, 1], [0, 1], [0, 1]])
+    tic()
+    for _ in range(1000):
+        bimage.sample_bimg_x(img=img, limits=limits, n=100)
+    toc("sample_bimg_x 1000x100")
+    sampler = bimage.BimgSampler(img=img, limits=limits)
+    tic()
+    for _ in range(1000):
+        sampler.sample_x(n=100)
+    toc("BimgSampler   1000x100")
+
+
+def test_bimg2sdf():
+    import tracemalloc
+    for n_dim, shape in [(2, (128, 128)), (3, (64, 64, 64))]:
+        limits = np.zeros((n_dim, 2))
+        limits[:, 1] = 1
+        c, r = np.full(n_dim, 0.5), 0.2
+        from wzk import grid
+        x_c = grid.i2x(i=np.array(list(np.ndindex(shape))), limits=limits, shape=shape, mode="c")
+        img = (np.linalg.norm(x_c - c, axis=-1) < r).reshape(shape)
+        sdf = bimage.bimg2sdf(img=img, limits=limits)
+        assert np.allclose(sdf.d_voxel * sdf.voxel_size, sdf.d)
+
+        x = np.random.uniform(low=0.1, high=0.9, size=(1000, n_dim))
+        x = x[np.abs(np.linalg.norm(x - c, axis=-1) - r) > 0.05]  # away from the center and the surface kinks
+        d, g = sdf.query(x)
+        d_true = np.linalg.norm(x - c, axis=-1) - r
+        g_true = (x - c) / np.linalg.norm(x - c, axis=-1, keepdims=True)
+        assert np.abs(d - d_true).max() < sdf.voxel_size
+        assert np.abs(g - g_true).mean() < 0.05
+
+        out = (np.empty(len(x)), np.empty((len(x), n_dim)))
+        d2, g2 = sdf.query(x, out=out)
+        assert d2 is out[0] and g2 is out[1]
+        assert np.array_equal(d, d2) and np.array_equal(g, g2)
+        assert np.array_equal(sdf.query(x, gradient=False), d)
+
+        tracemalloc.start()
+        sdf.query(x, out=out)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert peak < x.nbytes / 4
+
+        # exact on the voxel centers
+        i = np.array(list(np.ndindex(shape)))[::97]
+        assert np.allclose(sdf.query(grid.i2x(i=i, limits=limits, shape=shape, mode="c"), gradient=False),
+                           sdf.d[tuple(i.T)])
+
+
+def speed_sdf_query():
+    from wzk import tic, toc
+    limits = np.array([[0, 1]] * 3)
+    img = bimage.spheres2bimg(x=np.random.random((100, 3)), r=0.05, shape=(64, 64, 64), limits=limits)
+    tic()
+    sdf = bimage.bimg2sdf(img=img, limits=limits)
+    toc("bimg2sdf 64^3")
+
+    x = np.random.random((1000000, 3))
+    out = (np.empty(len(x)), np.empty((len(x), 3)))
+    sdf.query(x, out=out)
+    tic()
+    for _ in range(10):
+        sdf.query(x, out=out)
+    toc("10x query 1M points")
+
+
+def speed_spheres2bimg():
+    from wzk import tic, toc
+    for n_dim, shape in [(2, (256, 256)), (3, (64, 64, 64))]:
+        limits = np.zeros((n_dim, 2))
+        limits[:, 1] = 1
+        r_list = np.linspace(0.01, 0.05, 10)
+        stencil_dict = {int((r_ // (1/shape[0])) * 2 + 3):
+                        np.logical_or(*bimage.get_sphere_stencil(r=r_, voxel_size=1/shape[0], n_dim=n_dim))
+                        for r_ in r_list}
+        for n in [1000, 10000, 100000]:
+            x = np.random.random((n, n_dim))
+            r = np.random.choice(r_list, size=n)
+            tic()
+            img = bimage.spheres2bimg(x=x, r=r, shape=shape, limits=limits, stencil_dict=stencil_dict)
+            toc(f"batch {n_dim}D n={n}")
+            tic()
+            img_loop = __spheres2bimg_loop(x=x, r=r, shape=shape, limits=limits, stencil_dict=stencil_dict)
+            toc(f"loop  {n_dim}D n={n}")
+            assert np.array_equal(img, img_loop)
+
+
 if __name__ == "__main__":
     test_spheres2bimg()
     # test_get_sphere_stencil()
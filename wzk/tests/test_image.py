@@ -14,3 +14,63 @@ class Test(TestCase):
         img2 = image.compressed2img(img_cmp=img_cmp, shape=size, n_dim=n_dim, dtype=float)
 
         self.assertTrue(np.allclose(img, img2))
+
+    def test_img2compressed_threads(self):
+        size = (10, 16, 17)
+        img = np.random.random(size) < 0.1
+        img_cmp = image.img2compressed(img=img, n_dim=2, n_threads=3)
+        self.assertEqual(img_cmp.shape, (10,))
+        img2 = image.compressed2img(img_cmp=img_cmp, shape=size[1:], n_dim=2, dtype=bool, n_threads=3)
+        self.assertTrue(np.array_equal(img, img2))
+
+    def test_img2compressed_nested(self):
+        from wzk import mp2
+        img = np.random.random((10, 16, 17)) < 0.1
+
+        def fun(i):  # the threads of img2compressed must not wait for the busy threads of mp_wrapper
+            img_cmp = image.img2compressed(img=img[i], n_dim=2, n_threads=4)
+            return image.compressed2img(img_cmp=img_cmp, shape=img.shape[1:], n_dim=2, dtype=bool, n_threads=4)
+
+        img2 = mp2.mp_wrapper(np.arange(10), fun=fun, n_processes=4, backend="thread")
+        self.assertTrue(np.array_equal(img, img2))
+
+    def test_import_start_method(self):
+        import sys
+        import subprocess
+        script = "\n".join(["import multiprocessing",
+                            "multiprocessing.set_start_method('spawn')",
+                            "import wzk.image, wzk.sql2",
+                            "assert multiprocessing.get_start_method() == 'spawn'"])
+        subprocess.run([sys.executable, "-c", script], check=True, timeout=60)
+
+    def test_compressed_imgs(self):
+        import os
+        import tempfile
+        size = (10, 16, 17)
+        img = np.random.random(size) < 0.1
+        img_cmp = image.img2compressed(img=img, n_dim=2, container=True)
+        self.assertTrue(np.array_equal(img[3], img_cmp.decompress(3)))
+        img2 = image.compressed2img(img_cmp=img_cmp, shape=size[1:], n_dim=2, dtype=bool, n_threads=2)
+        self.assertTrue(np.array_equal(img, img2))
+
+        img_cmp2 = image.CompressedImgs.frombuffer(img_cmp.tobytes(), img_shape=size[1:], dtype=bool)
+        self.assertTrue(np.array_equal(img[7], img_cmp2.decompress(7)))
+
+        file = os.path.join(tempfile.mkdtemp(), "img_cmp.bin")
+        img_cmp.save(file)
+        img_cmp2 = image.CompressedImgs.load(file, img_shape=size[1:], dtype=bool, mmap=True)
+        self.assertEqual(len(img_cmp2), 10)
+        self.assertTrue(np.array_equal(img[9], img_cmp2.decompress(9)))
+        img2 = image.compressed2img(img_cmp=img_cmp2, shape=size[1:], n_dim=2, dtype=bool)
+        self.assertTrue(np.array_equal(img, img2))
+
+    def speed_img2compressed(self):
+        from wzk import tic, toc
+        img = np.random.random((64, 64, 64, 64)) < 0.05
+        for n_threads in [1, 4]:
+            tic()
+            img_cmp = image.img2compressed(img=img, n_dim=3, n_threads=n_threads)
+            toc(f"compress   n_threads={n_threads}")
+            tic()
+            image.compressed2img(img_cmp=img_cmp, shape=64, n_dim=3, dtype=bool, n_threads=n_threads)
+            toc(f"decompress n_threads={n_threads}")
@@ -1,4 +1,6 @@
+import os
 import time
+import multiprocessing
 from unittest import TestCase
 
 import numpy as np
@@ -6,6 +8,13 @@ from wzk.time2 import tic, toc
 from wzk import mp2, ltd
 
 
+CONFIG = {"k": 1}
+
+
+def fun_config(x):
+    return x + CONFIG["k"]
+
+
 class Test(TestCase):
     def test_mp_wrapper(self):
 
@@ -65,6 +74,278 @@ class Test(TestCase):
             self.assertTrue(np.allclose(res6[i-1], np.full((1007, i), i)))
         self.assertTrue(all(ltd.list_allclose(res6[:2], res6b[:2])))
 
+    def test_pool(self):
+        def fun_pid(n):
+            return np.full(n, os.getpid())
+
+        pool = mp2.set_pool(n_processes=4)
+        pid_pool = [p.pid for p in pool._pool]  # noqa
+        pid1 = mp2.mp_wrapper(100, fun=fun_pid, n_processes=4)
+        pid2 = mp2.mp_wrapper(100, fun=fun_pid, n_processes=4)
+        self.assertTrue(np.all(np.isin(pid1, pid_pool)))
+        self.assertTrue(np.all(np.isin(pid2, pid_pool)))
+
+        pid3 = mp2.mp_wrapper(100, fun=fun_pid, n_processes=4, pool=False)
+        self.assertTrue(len(np.intersect1d(pid1, pid3)) == 0)
+
+        lock = multiprocessing.Lock()  # not picklable -> fall back to forking
+
+        def fun_lock(x):
+            with lock:
+                return x * 2
+
+        x = np.arange(100)
+        self.assertTrue(np.array_equal(mp2.mp_wrapper(x, fun=fun_lock, n_processes=4), x * 2))
+        self.assertTrue(np.array_equal(mp2.mp_wrapper(x, fun=fun_lock, n_processes=4, max_chunk_size=7), x * 2))
+        mp2.close_pool()
+
+        # the pool is opt-in, by default the forked processes see the current module state
+        mp2.mp_wrapper(x, fun=fun_config, n_processes=2, pool=True)
+        try:
+            CONFIG["k"] = 100
+            self.assertTrue(np.array_equal(mp2.mp_wrapper(x, fun=fun_config, n_processes=2), x + 100))
+        finally:
+            CONFIG["k"] = 1
+            mp2.close_pool()
+
+    def test_pool_late_fun(self):
+        import sys
+        import subprocess
+
+        # __main__ function defined after the pool was started, sent by value with its current globals
+        script = "\n".join(["import numpy as np",
+                            "from wzk import mp2",
+                            "mp2.set_pool(n_processes=2)",
+                            "offset = 1",
+                            "def fun(x):",
+                            "    return x + offset",
+                            "offset = 2",
+                            "x = np.arange(100)",
+                            "assert np.array_equal(mp2.mp_wrapper(x, fun=fun, n_processes=2), x + 2)"])
+        subprocess.run([sys.executable, "-c", script], check=True, timeout=60)
+
+        # importable function which does not exist in the workers yet -> fall back to forking
+        mp2.set_pool(n_processes=2)
+
+        def fun_late(x):
+            return x * 3
+
+        fun_late.__qualname__ = "__fun_late"
+        setattr(sys.modules[__name__], "__fun_late", fun_late)
+        try:
+            x = np.arange(100)
+            self.assertTrue(np.array_equal(mp2.mp_wrapper(x, fun=fun_late, n_processes=2), x * 3))
+            self.assertTrue(np.array_equal(np.concatenate([r for _, r in sorted(mp2.imap(fun_late, x, chunk_size=10,
+                                                                                       n_processes=2))]), x * 3))
+        finally:
+            delattr(sys.modules[__name__], "__fun_late")
+            mp2.close_pool()
+
+    def test_shared_memory(self):
+        def fun__multiple_arr_in(a1, a2):
+            return a1 + a2, (a1 * a2).sum(axis=-1) > 1
+
+        def fun__int_in(n):
+            return np.full((n, 2, 3), 7, dtype=np.uint8)
+
+        a = np.random.random((1001, 3))
+        b = np.random.random((1001, 3))
+        c, d = fun__multiple_arr_in(a, b)
+        for pool in [True, False]:
+            c2, d2 = mp2.mp_wrapper(a, b, fun=fun__multiple_arr_in, n_processes=4, pool=pool, shared_memory=True)
+            self.assertTrue(np.array_equal(c, c2))
+            self.assertTrue(np.array_equal(d, d2))
+
+            c2, d2 = mp2.mp_wrapper(a, b, fun=fun__multiple_arr_in, n_processes=4, pool=pool, shared_memory=True,
+                                    max_chunk_size=10, out=[((3,), np.float64), ((), bool)])
+            self.assertTrue(np.array_equal(c, c2))
+            self.assertTrue(np.array_equal(d, d2))
+
+            e = mp2.mp_wrapper(1001, fun=fun__int_in, n_processes=4, pool=pool, shared_memory=True)
+            self.assertTrue(np.array_equal(e, fun__int_in(1001)))
+
+        with self.assertRaises(ValueError):
+            mp2.mp_wrapper(1001, fun=lambda n: (np.zeros(n), 11), n_processes=4, shared_memory=True)
+        mp2.close_pool()
+
+    def test_schedule(self):
+        chunks = mp2.get_chunks(n_samples=1000, n_processes=4, schedule="guided", min_chunk_size=5)
+        self.assertTrue(chunks[0] == (0, 125))
+        self.assertTrue(np.array_equal(np.ravel(chunks)[1:-1:2], np.ravel(chunks)[2::2]))
+        self.assertTrue(chunks[-1][1] == 1000)
+        self.assertTrue(all(b - a >= 5 for a, b in chunks[:-1]))
+
+        lock = multiprocessing.Lock()
+
+        def fun(x):
+            with lock:
+                time.sleep(0.001 * (x[:, 0] > 0.9).sum())
+            return x * 2, x.sum(axis=-1)
+
+        x = np.random.random((1001, 3))
+        for pool in [True, False]:
+            for shared_memory in [False, True]:
+                for f in [fun, lambda x_: (x_ * 2, x_.sum(axis=-1))]:
+                    y, z = mp2.mp_wrapper(x, fun=f, n_processes=4, schedule="guided", pool=pool,
+                                          shared_memory=shared_memory, verbose=1)
+                    self.assertTrue(np.array_equal(y, x * 2))
+                    self.assertTrue(np.array_equal(z, x.sum(axis=-1)))
+        mp2.close_pool()
+
+    def test_exception(self):
+        lock = multiprocessing.Lock()  # not picklable -> fork path
+
+        def fun_lock(x):
+            with lock:
+                if x[0] >= 500:
+                    raise ZeroDivisionError(f"fork {x[0]}")
+            return x
+
+        def fun(x):
+            if x[0] >= 500:
+                raise ZeroDivisionError(f"pool {x[0]}")
+            return x
+
+        x = np.arange(1000)
+        for f in [fun_lock, fun]:
+            for shared_memory in [False, True]:
+                with self.assertRaises(ZeroDivisionError):
+                    mp2.mp_wrapper(x, fun=f, n_processes=4, shared_memory=shared_memory, out=((), int))
+
+        y = mp2.mp_wrapper(x[:500], fun=fun_lock, n_processes=4, schedule="guided")
+        self.assertTrue(np.array_equal(y, x[:500]))
+        mp2.close_pool()
+
+    def test_imap(self):
+        lock = multiprocessing.Lock()
+
+        def fun_lock(x):
+            with lock:
+                pass
+            return x * 2
+
+        x = np.arange(1003)
+        for f in [fun_lock, lambda x_: x_ * 2]:
+            for n_processes in [1, 4]:
+                res = dict(mp2.imap(f, x, chunk_size=100, n_processes=n_processes))
+                self.assertTrue(sorted(res) == list(range(11)))
+                self.assertTrue(np.array_equal(np.concatenate([res[i] for i in range(11)]), x * 2))
+
+        def fun_slow(x):
+            if x[0] == 0:
+                raise ZeroDivisionError
+            time.sleep(1)
+            return x
+
+        for pool in [True, False]:
+            tic()
+            with self.assertRaises(ZeroDivisionError):
+                list(mp2.imap(fun_slow, x, chunk_size=100, n_processes=4, pool=pool))
+            self.assertTrue(toc("") < 1)
+
+            for i, _ in mp2.imap(lambda x_: x_, x, chunk_size=10, n_processes=4, pool=pool):
+                break
+        mp2.close_pool()
+
+    def test_backend(self):
+        def fun__multiple_out(n):
+            return tuple(np.full((n, ii), ii) for ii in range(1, 3)) + (11, 12)
+
+        def fun(x):
+            return x @ x.swapaxes(-1, -2), np.linalg.norm(x, axis=-1)
+
+        x = np.random.random((1001, 3, 3))
+        y, z = fun(x)
+        for backend in mp2.BACKENDS:
+            for schedule in ["static", "guided"]:
+                y2, z2 = mp2.mp_wrapper(x, fun=fun, n_processes=4, backend=backend, schedule=schedule)
+                self.assertTrue(np.allclose(y, y2))
+                self.assertTrue(np.allclose(z, z2))
+
+            res = mp2.mp_wrapper(1007, fun=fun__multiple_out, n_processes=4, backend=backend, max_chunk_size=10)
+            res_loop = mp2.mp_wrapper(1007, fun=fun__multiple_out, n_processes=4, use_loop=True, max_chunk_size=10)
+            self.assertTrue(all(ltd.list_allclose(res, res_loop)))
+
+        y2, z2 = mp2.mp_wrapper(x, fun=fun, n_processes=4, backend="thread", shared_memory=True)
+        self.assertTrue(np.allclose(y, y2))
+
+        res = dict(mp2.imap(fun, x, chunk_size=100, n_processes=4, backend="thread"))
+        self.assertTrue(np.allclose(np.concatenate([res[i][1] for i in range(len(res))]), z))
+
+        self.assertTrue(mp2.get_backend_auto(fun=fun, args=(x,)) == "process")
+        self.assertTrue(mp2.get_backend_auto(fun=mp2.releases_gil(fun), args=(x,)) == "thread")
+        mp2.set_thread_nbytes(x.nbytes - 1)
+        fun.releases_gil = None
+        self.assertTrue(mp2.get_backend_auto(fun=fun, args=(x,)) == "thread")
+        mp2.set_thread_nbytes(2 ** 26)
+        mp2.close_pool()
+
+    def speed_backend(self):
+        def fun(x):
+            return np.array([np.linalg.svd(xx)[1] for xx in x])
+
+        x = np.random.random((64, 300, 300))
+        for backend in ["serial", "process", "thread"]:
+            tic()
+            mp2.mp_wrapper(x, fun=fun, n_processes=8, backend=backend)
+            toc(f"backend={backend}")
+        mp2.close_pool()
+
+    def test_executor(self):
+        def fun(i, x, d):
+            return i, x[i].sum() + d["a"]
+
+        x = np.random.random((1000, 500))
+        d = {"a": 1}
+        for backend in ["process", "thread"]:
+            with mp2.PoolExecutor(n_workers=4, backend=backend) as executor:
+                x_ref, d_ref = executor.put(x), executor.put(d)
+                futures = executor.submit_batch(fun, [(i,) for i in range(10)], x=x_ref, d=d_ref)
+                res = executor.get(futures)
+                self.assertTrue(res == [(i, x[i].sum() + 1) for i in range(10)])
+                self.assertTrue(executor.get(executor.submit(fun, 3, x, d=d)) == (3, x[3].sum() + 1))
+
+                res = list(executor.map(fun, ((i,) for i in range(1000)), max_in_flight=8, x=x, d=d))
+                self.assertTrue(res == [(i, x[i].sum() + 1) for i in range(1000)])
+
+    def speed_schedule(self):
+        def fun(x):
+            time.sleep(0.1 * (x > 900).sum())  # the last samples are expensive
+            return x
+
+        x = np.arange(1000)
+        for schedule in ["static", "guided"]:
+            tic()
+            mp2.mp_wrapper(x, fun=fun, n_processes=8, schedule=schedule, verbose=1)
+            toc(f"schedule={schedule}")
+        mp2.close_pool()
+
+    def speed_shared_memory(self):
+        def fun(x):
+            return x * 2
+
+        x = np.random.random((1000000, 64))
+        mp2.set_pool(n_processes=8)
+        for shared_memory in [False, True]:
+            tic()
+            mp2.mp_wrapper(x, fun=fun, n_processes=8, shared_memory=shared_memory)
+            toc(f"shared_memory={shared_memory}")
+        mp2.close_pool()
+
+    def speed_pool(self):
+        def fun_small(x):
+            return x * 2
+
+        x = np.arange(1000)
+        n = 100
+        mp2.set_pool(n_processes=8)
+        for pool in [False, True]:
+            tic()
+            for _ in range(n):
+                mp2.mp_wrapper(x, fun=fun_small, n_processes=8, pool=pool)
+            toc(f"pool={pool}, {n} calls")
+        mp2.close_pool()
+
     def test_time(self):
 
         def fun_time():
@@ -24,3 +24,14 @@ class Test(TestCase):
 
         # fig, ax = mpl2.new_fig(aspect=1)
         # ax.plot(*y.T, 'ro')
+
+    def test_alias_table(self):
+        for p in [np.random.random(1000), np.r_[1e6, np.ones(999)], np.r_[np.zeros(500), np.random.random(500)**5]]:
+            prob, alias = random2.alias_table(p)
+            q = prob.copy()
+            np.add.at(q, alias, 1 - prob)
+            self.assertTrue(np.allclose(q / len(p), p / p.sum()))
+
+        p = np.array([0.1, 0.0, 0.6, 0.3])
+        j = random2.sample_alias(*random2.alias_table(p), n=100000)
+        self.assertTrue(np.allclose(np.bincount(j, minlength=4) / len(j), p, atol=0.01))
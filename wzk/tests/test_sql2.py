@@ -1,5 +1,6 @@
 from unittest import TestCase
 import os
+import sqlite3
 
 import numpy as np
 import pandas as pd
@@ -116,6 +117,201 @@ class Test(TestCase):
         v1 = v1.reshape((2, 20, 4))
         self.assertTrue(np.array_equal(v, v1))
 
+    def test_bytes2values(self):
+        v = np.random.random((5, 20, 4)).astype(np.float32)
+        b = sql2.values2bytes(value=v, column="A_f32")
+        self.assertTrue(b[3] == v[3].tobytes())
+
+        v1 = sql2.bytes2values(value=b, column="A_f32")
+        self.assertTrue(v1.shape == (5, 80))
+        v1[:] = 0  # result is writable
+
+        col = sql2.Col(name="A_f32", type_sql=sql2.TYPE_BLOB, type_np="f32", shape=(20, 4))
+        v2 = sql2.bytes2values(value=b, column=col)
+        self.assertTrue(np.array_equal(v, v2))
+
+        b = [np.ones(i, dtype=np.float32).tobytes() for i in range(1, 4)]
+        v3 = sql2.bytes2values(value=b, column="A_f32")
+        self.assertTrue(v3.dtype == object)
+        self.assertTrue(all(np.array_equal(v3[i], np.ones(i+1)) for i in range(3)))
+
+    def test_get_values_col_shape(self):
+        file = f"{directory}/dummy_test_get_values_col_shape.db"
+        table = "dummytable"
+        df = self.__create_dummy_db("D")
+        sql2.df2sql(df=df, file=file, table=table, if_exists="replace")
+
+        col = sql2.Col(name="A_f32", type_sql=sql2.TYPE_BLOB, type_np="f32", shape=(20, 4))
+        v = sql2.get_values(file=file, table=table, columns=col)
+        self.assertTrue(v.shape == (8, 20, 4))
+        v = np.concatenate(list(sql2.iter_values(file=file, table=table, columns=[col], chunk_size=3)))
+        self.assertTrue(v.shape == (8, 20, 4))
+
+    def speed_bytes2values(self):
+        from wzk import tic, toc
+        v = np.random.random((100000, 64)).astype(np.float32)
+
+        tic()
+        b = [vv.tobytes() for vv in v]
+        toc("encode per row")
+        tic()
+        b = sql2.values2bytes(value=v, column="x_f32")
+        toc("encode void view")
+
+        tic()
+        _ = np.array([np.frombuffer(bb, dtype=np.float32) for bb in b])
+        toc("decode per row")
+        tic()
+        _ = sql2.bytes2values(value=b, column="x_f32")
+        toc("decode joined buffer")
+
+    def test_append_values(self):
+        file = f"{directory}/dummy_test_append_values.db"
+        table = sql2.Table(table="dummytable",
+                           cols=[sql2.Col(name="A_f32", type_sql=sql2.TYPE_BLOB, type_np="f32", shape=(20, 4)),
+                                 sql2.Col(name="B", type_sql=sql2.TYPE_INTEGER, type_np="i64", shape=1),
+                                 sql2.Col(name="C", type_sql=sql2.TYPE_REAL, type_np="f64", shape=1)])
+        a = np.random.random((10, 20, 4)).astype(np.float32)
+        b = np.arange(10)
+        c = np.random.random(10)
+        sql2.append_values(file=file, table=table, values=(a, b, c), batch_size=3)
+        sql2.append_values(file=file, table=table(), columns=["B"], values=b)
+
+        self.assertTrue(sql2.get_n_rows(file=file, table=table()) == 20)
+        self.assertTrue(np.array_equal(sql2.get_columns(file=file, table=table(), mode="type"), table.types_sql()))
+        a2, b2, c2 = sql2.get_values(file=file, table=table(), columns=table.cols, rows=np.arange(10))
+        self.assertTrue(np.array_equal(a, a2))
+        self.assertTrue(np.array_equal(b, b2))
+        self.assertTrue(np.array_equal(c, c2))
+        self.assertTrue(np.array_equal(b, sql2.get_values(file=file, table=table(), columns="B",
+                                                          rows=np.arange(10, 20))))
+
+        sql2.append_values(file=file, table="inferred", columns=["x_f32", "i", "s"],
+                           values=(a, b, b.astype(str)))
+        self.assertTrue(np.array_equal(sql2.get_columns(file=file, table="inferred", mode="type"),
+                                       [sql2.TYPE_BLOB, sql2.TYPE_INTEGER, sql2.TYPE_TEXT]))
+
+    def speed_append_values(self):
+        from wzk import tic, toc
+        n = int(1e6)
+        a = np.random.random((n, 8)).astype(np.float32)
+        b = np.arange(n)
+        c = np.random.random(n)
+
+        file = f"{directory}/dummy_speed_append_values_df.db"
+        tic()
+        df = pd.DataFrame(data=dict(a_f32=list(a), b=b, c=c))
+        sql2.df2sql(df=df, file=file, table="dummytable", if_exists="append")
+        toc("df2sql")
+
+        file = f"{directory}/dummy_speed_append_values.db"
+        tic()
+        sql2.append_values(file=file, table="dummytable", columns=["a_f32", "b", "c"], values=(a, b, c))
+        toc("append_values")
+
+    def test_rows2where(self):
+        self.assertTrue(sql2.rows2where(-1) == ("", []))
+        self.assertTrue(sql2.rows2where(np.arange(10, 100000)) == (" WHERE ROWID BETWEEN 11 AND 100000", []))
+        self.assertTrue(sql2.rows2where([5, 0, 1, 2, 7]) ==
+                        (" WHERE ROWID BETWEEN 1 AND 3 OR ROWID = 6 OR ROWID = 8", []))
+        self.assertTrue(sql2.rows2where(np.arange(0, 600, 2))[0].startswith(" WHERE ROWID in (1, 3, 5"))
+        where, params = sql2.rows2where(np.arange(0, 2000, 2))
+        self.assertTrue(where == " WHERE ROWID IN (SELECT value FROM json_each(?))")
+        self.assertTrue(params[0].startswith("[1, 3, 5"))
+
+    def test_get_values_rows(self):
+        file = f"{directory}/dummy_test_get_values_rows.db"
+        table = "dummytable"
+        n = 5000
+        sql2.append_values(file=file, table=table, columns=["i"], values=np.arange(n))
+
+        for rows in [np.arange(100, 3000),
+                     np.random.choice(n, size=2000, replace=False),  # json_each
+                     np.random.choice(n, size=300, replace=False),  # IN list
+                     np.random.random(n) < 0.5]:
+            i = sql2.get_values(file=file, table=table, columns="i", rows=rows)
+            i2 = np.concatenate(list(sql2.iter_values(file=file, table=table, columns="i", rows=rows)))
+            self.assertTrue(np.array_equal(i, np.nonzero(rows)[0] if rows.dtype == bool else np.sort(rows)))
+            self.assertTrue(np.array_equal(i, i2))
+
+        # interleaved scattered queries on the same persistent connection
+        with sql2.Database(file):
+            rows_a = np.random.choice(n, size=2000, replace=False)
+            rows_b = np.random.choice(n, size=2000, replace=False)
+            i_a = []
+            for i in sql2.iter_values(file=file, table=table, columns="i", rows=rows_a, chunk_size=100):
+                i_a.append(i)
+                self.assertTrue(np.array_equal(sql2.get_values(file=file, table=table, columns="i", rows=rows_b),
+                                               np.sort(rows_b)))
+            self.assertTrue(np.array_equal(np.concatenate(i_a), np.sort(rows_a)))
+
+        rows = np.random.choice(n, size=2000, replace=False)
+        sql2.delete_rows(file=file, table=table, rows=rows)
+        i = sql2.get_values(file=file, table=table, columns="i")
+        self.assertTrue(np.array_equal(i, np.setdiff1d(np.arange(n), rows)))
+
+    def speed_get_values_rows(self):
+        from wzk import tic, toc
+        file = f"{directory}/dummy_speed_get_values_rows.db"
+        table = "dummytable"
+        n = int(1e6)
+        sql2.append_values(file=file, table=table, columns=["i"], values=np.arange(n))
+
+        rows = np.arange(1000, 501000)
+        tic()
+        with sql2.open_db_connection(file=file) as con:
+            pd.read_sql_query(con=con, sql=f"SELECT i FROM {table} WHERE ROWID in ({sql2.rows2sql(rows)})")
+        toc("ROWID in (...)")
+        tic()
+        sql2.get_values(file=file, table=table, columns="i", rows=rows)
+        toc("ROWID BETWEEN")
+
+        rows = np.random.choice(n, size=100000, replace=False)
+        tic()
+        with sql2.open_db_connection(file=file) as con:
+            pd.read_sql_query(con=con, sql=f"SELECT i FROM {table} WHERE ROWID in ({sql2.rows2sql(rows)})")
+        toc("ROWID in (...) scattered")
+        tic()
+        sql2.get_values(file=file, table=table, columns="i", rows=rows)
+        toc("json_each scattered")
+
+    def test_vacuum_policy(self):
+        table = "dummytable"
+
+        def freelist_count(f):
+            with sql2.open_db_connection(file=f) as con:
+                return con.execute("PRAGMA freelist_count").fetchone()[0]
+
+        def create(f):
+            sql2.append_values(file=f, table=table, columns=["a_f64", "b"],
+                               values=(np.random.random((2000, 100)), np.arange(2000)))
+
+        file = f"{directory}/dummy_test_vacuum_policy_deferred.db"
+        create(file)
+        with sql2.deferred_vacuum():
+            sql2.delete_rows(file=file, table=table, rows=np.arange(1000))
+            self.assertTrue(freelist_count(file) > 0)
+        self.assertTrue(freelist_count(file) == 0)
+
+        file = f"{directory}/dummy_test_vacuum_policy_deferred_db.db"
+        create(file)
+        with sql2.Database(file, vacuum_policy="deferred"):
+            sql2.delete_rows(file=file, table=table, rows=np.arange(1000))
+            sql2.delete_columns(file=file, table=table, columns="a_f64")
+            self.assertTrue(freelist_count(file) > 0)
+        self.assertTrue(freelist_count(file) == 0)
+
+        file = f"{directory}/dummy_test_vacuum_policy_incremental.db"
+        create(file)
+        sql2.set_vacuum_policy(policy="incremental")
+        try:
+            sql2.delete_rows(file=file, table=table, rows=np.arange(1000))
+            self.assertTrue(freelist_count(file) == 0)
+            with sql2.open_db_connection(file=file) as con:
+                self.assertTrue(con.execute("PRAGMA auto_vacuum").fetchone()[0] == 2)
+        finally:
+            sql2.set_vacuum_policy(policy="immediate")
+
     def test_add_column(self):
         file = f"{directory}/dummy_test_set_values_3.db"
         table = "dummytable"
@@ -190,6 +386,349 @@ class Test(TestCase):
         self.assertTrue(isinstance(aa[0], np.int64))
         self.assertTrue(isinstance(cc[0], float))
 
+    def test_iter_values(self):
+        file = f"{directory}/dummy_test_iter_values.db"
+        table = "dummytable"
+        df = self.__create_dummy_db("D")
+        sql2.df2sql(df=df, file=file, table=table, if_exists="replace")
+
+        a, b = sql2.get_values(file=file, table=table, columns=["A_f32", "B"])
+        chunks = list(sql2.iter_values(file=file, table=table, columns=["A_f32", "B"], chunk_size=3))
+        self.assertTrue(len(chunks) == 3)
+        self.assertTrue(np.array_equal(a, np.concatenate([c[0] for c in chunks])))
+        self.assertTrue(np.array_equal(b, np.concatenate([c[1] for c in chunks])))
+
+        r = [1, 4, 5]
+        b = sql2.get_values(file=file, table=table, columns="B", rows=r)
+        b2 = np.concatenate(list(sql2.iter_values(file=file, table=table, columns="B", rows=r, chunk_size=2)))
+        self.assertTrue(np.array_equal(b, b2))
+
+    def test_database(self):
+        file = f"{directory}/dummy_test_database.db"
+        table = "dummytable"
+        df = self.__create_dummy_db("D")
+        sql2.df2sql(df=df, file=file, table=table, if_exists="replace")
+
+        with sql2.Database(file) as db:
+            self.assertTrue(sql2.get_database(file) is db)
+            con = db.con
+            with sql2.open_db_connection(file=file) as con2:
+                self.assertTrue(con is con2)
+
+            r = [0, 1]
+            v = np.ones((2, 20, 4))
+            sql2.set_values(file=file, table=table, values=(v,), columns="A_f32", rows=r)
+            v1 = db.get_values(table=table, columns="A_f32", rows=r)
+            self.assertTrue(np.array_equal(v.reshape(2, -1), v1))
+            self.assertTrue(sql2.get_n_rows(file=db, table=table) == 8)
+
+        self.assertTrue(sql2.find_database(file) is None)
+        self.assertTrue(len(db.cons) == 0)
+
+        db = sql2.get_database(file)
+        self.assertTrue(sql2.get_database(file) is db)
+        sql2.close_databases()
+        self.assertTrue(sql2.find_database(file) is None)
+
+    def speed_database(self):
+        from wzk import tic, toc
+        file = f"{directory}/dummy_speed_database.db"
+        table = "dummytable"
+        df = self.__create_dummy_db("D")
+        sql2.df2sql(df=df, file=file, table=table, if_exists="replace")
+
+        n = 1000
+        tic()
+        for i in range(n):
+            sql2.get_values(file=file, table=table, columns="A_f32", rows=i % 8)
+        t0 = toc("open / close per call") / n
+
+        tic()
+        with sql2.Database(file):
+            for i in range(n):
+                sql2.get_values(file=file, table=table, columns="A_f32", rows=i % 8)
+        t1 = toc("persistent connection") / n
+        print(f"per call: {t0*1e6:.1f}us -> {t1*1e6:.1f}us")
+
+    def test_meta_cache(self):
+        import sqlite3
+        file = f"{directory}/dummy_test_meta_cache.db"
+        table = "dummytable"
+        df = self.__create_dummy_db("A")
+        sql2.df2sql(df=df, file=file, table=table, if_exists="replace")
+
+        self.assertTrue(sql2.get_tables(file=file) == [table])
+        self.assertTrue(sql2.get_n_rows(file=file, table=table) == 3)
+        self.assertTrue(table in sql2.get_meta(file=file)["n_rows"])
+
+        c = sql2.get_columns(file=file, table=table, mode="name")
+        self.assertTrue(table in sql2.get_meta(file=file)["columns"])
+        sql2.add_column(file=file, table=table, column="E", dtype=sql2.TYPE_REAL)
+        self.assertTrue(np.array_equal(sql2.get_columns(file=file, table=table, mode="name"), list(c) + ["E"]))
+
+        sql2.set_values(file=file, table=table, values=([1.0, 2.0],), columns="E", rows=[0, 1])
+        meta = sql2.get_meta(file=file)
+        self.assertTrue(meta["journal_mode"] == "wal")
+        self.assertTrue(table in meta["columns"])
+        sql2.append_values(file=file, table=table, columns=["A"], values=[4])
+        self.assertTrue(sql2.get_n_rows(file=file, table=table) == 4)
+
+        # changes from outside are detected through the file signature
+        con = sqlite3.connect(file)
+        con.execute("CREATE TABLE other (x INTEGER)")
+        con.execute(f"INSERT INTO {table} (A) VALUES (5)")
+        con.commit()
+        con.close()
+        self.assertTrue(sql2.get_tables(file=file) == [table, "other"])
+        self.assertTrue(sql2.get_n_rows(file=file, table=table) == 5)
+
+    def test_batch_loader(self):
+        from wzk import image
+        file = f"{directory}/dummy_test_batch_loader.db"
+        table = "dummytable"
+        n = 103
+        img = np.random.random((n, 8, 8)) < 0.5
+        sql2.append_values(file=file, table=table, columns=["i", "x_f32", "img_cmp"],
+                           values=(np.arange(n), np.random.random((n, 3)), image.img2compressed(img=img, n_dim=2)))
+
+        cmp = {"img_cmp": dict(shape=8, n_dim=2, dtype=bool)}
+        with sql2.BatchLoader(file=file, table=table, columns=["i", "img_cmp"], batch_size=10, seed=3,
+                              n_workers=3, prefetch=2, cmp=cmp) as loader:
+            self.assertTrue(len(loader) == 11)
+            epoch0 = [i for i, _ in loader]
+            for i, img_i in loader:
+                self.assertTrue(np.all(np.diff(i) > 0))
+                self.assertTrue(np.array_equal(img[i], img_i))
+
+        self.assertTrue(np.array_equal(np.sort(np.concatenate(epoch0)), np.arange(n)))
+        loader2 = sql2.BatchLoader(file=file, table=table, columns="i", batch_size=10, seed=3, block_size=5,
+                                   drop_last=True, backend="process")
+        epoch0b = list(loader2)
+        loader2.close()
+        self.assertTrue(len(epoch0b) == 10)
+        self.assertTrue(all(np.array_equal(a, b) for a, b in zip(epoch0, loader.get_batches(0))))
+        self.assertFalse(all(np.array_equal(a, b) for a, b in zip(epoch0, loader.get_batches(1))))
+        self.assertTrue(all(len(sql2.rows2ranges(b)[0]) <= 3 for b in epoch0b))
+
+        loader3 = sql2.BatchLoader(file=file, table=table, columns="i", batch_size=10, shuffle=False)
+        self.assertTrue(np.array_equal(np.concatenate(list(loader3)), np.arange(n)))
+        loader3.close()
+
+    def test_sharded_table(self):
+        directory_st = f"{directory}/dummy_test_sharded_table"
+        table = "dummytable"
+        st = sql2.ShardedTable(directory=directory_st, table=table, n_shards=3)
+        n = 20
+        i = np.arange(n)
+        x = np.random.random((n, 4))
+        rows = st.append_values(values=(i, x), columns=["i", "x_f64"])
+        self.assertTrue(np.array_equal(st.get_n_rows_shards(), [7, 7, 6]))
+        self.assertTrue(np.array_equal(rows, np.arange(n)))
+        self.assertTrue(np.array_equal(st.get_values(columns="x_f64"), x))
+
+        st = sql2.ShardedTable(directory=directory_st, table=table)  # from manifest
+        rows5 = st.append_values(values=(np.arange(n, n+5), np.zeros((5, 4))), columns=["i", "x_f64"], shard=1)
+        self.assertTrue(np.array_equal(rows5, [22, 25, 28, 31, 34]))
+        self.assertTrue(st.get_n_rows() == n + 5)
+        self.assertTrue(np.array_equal(st.get_rows(), np.sort(np.concatenate([rows, rows5]))))
+
+        # the global rows are stable, appending to one shard does not shift the others
+        i2, x2 = st.get_values(columns=["i", "x_f64"], rows=rows)
+        self.assertTrue(np.array_equal(i2, i))
+        self.assertTrue(np.array_equal(x2, x))
+        self.assertTrue(np.array_equal(st.get_values(columns="i", rows=rows5), np.arange(n, n+5)))
+        with self.assertRaises(AssertionError):
+            st.get_values(columns="i", rows=23)  # shard 2 has only 7 rows
+
+        rows = [0, 13, 6, 25, 14, 22]
+        i3 = st.get_values(columns="i", rows=rows)
+        i_all = st.get_values(columns="i")
+        self.assertTrue(np.array_equal(i3, i_all[np.searchsorted(st.get_rows(), np.sort(rows))]))
+
+        st.set_values(values=(-np.arange(6),), columns="i", rows=rows)
+        i4 = st.get_values(columns="i", rows=rows)
+        self.assertTrue(np.array_equal(i4, -np.arange(6)[np.argsort(rows)]))
+
+    def test_writer(self):
+        from wzk import mp2
+        file = f"{directory}/dummy_test_writer.db"
+        table = "dummytable"
+        n = 200
+        sql2.append_values(file=file, table=table, columns=["i", "x_f64"], values=(np.zeros(n), np.zeros((n, 3))))
+
+        with sql2.Writer(file=file, max_rows=50, max_time=0.05) as writer:
+            writer.poll_interval = 0.001  # the producers poll many times, they can not check the writer process
+
+            def fun(i):
+                for ii in i:
+                    writer.set_values(table=table, values=([ii], [np.full(3, ii)]), columns=["i", "x_f64"], rows=ii)
+                writer.append_values(table="other", values=i, columns="j")
+                writer.flush()  # barrier for the messages of this process
+                assert np.array_equal(sql2.get_values(file=file, table=table, columns="i", rows=i), i)
+                return i
+
+            mp2.mp_wrapper(np.arange(n), fun=fun, n_processes=4)
+            writer.flush()
+            i, x = sql2.get_values(file=file, table=table)
+            self.assertTrue(np.array_equal(i, np.arange(n)))
+            self.assertTrue(np.array_equal(x, np.repeat(np.arange(n)[:, np.newaxis], 3, axis=1)))
+            self.assertTrue(np.array_equal(np.sort(sql2.get_values(file=file, table="other")), np.arange(n)))
+
+            # a bad message is reported by flush, but neither kills the writer nor the other messages
+            writer.set_values(table=table, values=(5,), columns="i", rows=0)
+            writer.set_values(table="no_table", values=([5],), columns="i", rows=0)
+            writer.set_values(table=table, values=([7],), columns="i", rows=1)
+            with self.assertRaises(RuntimeError):
+                writer.flush(timeout=10)
+            self.assertTrue(writer.process.is_alive())
+            self.assertTrue(sql2.get_values(file=file, table=table, columns="i", rows=1) == 7)
+            writer.set_values(table=table, values=([8],), columns="i", rows=1)
+            writer.flush(timeout=10)
+            self.assertTrue(sql2.get_values(file=file, table=table, columns="i", rows=1) == 8)
+
+        writer = sql2.Writer(file=file)
+        writer.poll_interval = 0.1
+        writer.process.kill()
+        writer.process.join()
+        writer.set_values(table=table, values=([9],), columns="i", rows=1)
+        with self.assertRaises(RuntimeError):  # instead of waiting forever
+            writer.flush()
+        writer.close()
+
+    def speed_writer(self):
+        from wzk import mp2, tic, toc
+        import multiprocessing
+        file = f"{directory}/dummy_speed_writer.db"
+        table = "dummytable"
+        n = 32 * 100
+        sql2.append_values(file=file, table=table, columns=["x_f64"], values=np.zeros((n, 16)))
+        lock = multiprocessing.Lock()
+
+        def fun_lock(i):
+            for ii in i:
+                sql2.set_values(file=file, table=table, values=(np.ones((1, 16)),), columns="x_f64", rows=ii, lock=lock)
+            return i
+
+        tic()
+        mp2.mp_wrapper(np.arange(n), fun=fun_lock, n_processes=32)
+        toc("set_values with lock, 32 producers")
+
+        writer = sql2.Writer(file=file)
+
+        def fun_writer(i):
+            for ii in i:
+                writer.set_values(table=table, values=(np.ones((1, 16)),), columns="x_f64", rows=ii)
+            return i
+
+        tic()
+        mp2.mp_wrapper(np.arange(n), fun=fun_writer, n_processes=32)
+        writer.close()
+        toc("Writer, 32 producers")
+
+    def test_columnar(self):
+        file = f"{directory}/dummy_test_columnar.db"
+        table = "dummytable"
+        n = 50
+        x = np.random.random((n, 4, 3)).astype(np.float32)
+        sql2.append_values(file=file, table=table, columns=["i", "x_f32"], values=(np.arange(n), x))
+
+        col = sql2.Col(name="x_f32", type_sql=sql2.TYPE_BLOB, type_np="f32", shape=(4, 3))
+        directory_c = sql2.to_columnar(file=file, table=table, columns=["i", col], chunk_size=7)
+        self.assertTrue(sql2.get_columnar(file=file, table=table) is not None)
+
+        x2 = np.load(f"{directory_c}/x_f32.npy", mmap_mode="r")
+        self.assertTrue(np.array_equal(x, x2))
+
+        i, x3 = sql2.get_values(file=file, table=table, columns=["i", "x_f32"], rows=np.arange(10, 20))
+        self.assertTrue(isinstance(x3, np.memmap))  # served from the cache
+        self.assertFalse(x3.flags.writeable)
+        self.assertTrue(np.array_equal(x3, x[10:20].reshape(10, -1)))
+        x4 = sql2.get_values(file=file, table=table, columns=col, rows=[3, 1, 40])
+        self.assertTrue(np.array_equal(x4, x[[1, 3, 40]]))
+        for rows in [[], [n + 5], [3, n]]:  # empty and out of range selections fall back to SQL
+            x5 = sql2.get_values(file=file, table=table, columns="x_f32", rows=rows)
+            sql2.unset_columnar(file=file, table=table)
+            self.assertTrue(np.array_equal(x5, sql2.get_values(file=file, table=table, columns="x_f32", rows=rows)))
+            sql2.set_columnar(directory=directory_c)
+
+        sql2.set_values(file=file, table=table, values=([-1],), columns="i", rows=0)  # cache is stale now
+        hash_file = sql2.hash2.hash_file
+        n_hash = []
+        try:
+            sql2.hash2.hash_file = lambda f: n_hash.append(f) or hash_file(f)
+            for _ in range(3):  # the file is hashed only once for the stale signature
+                self.assertTrue(sql2.get_columnar(file=file, table=table) is None)
+                self.assertTrue(sql2.get_values(file=file, table=table, columns="i", rows=0) == -1)
+        finally:
+            sql2.hash2.hash_file = hash_file
+        self.assertTrue(len(n_hash) == 1)
+        sql2.unset_columnar(file=file, table=table)
+
+    def test_rebuild_table(self):
+        file = f"{directory}/dummy_test_rebuild_table.db"
+        table = "dummytable"
+        n = 25
+        a = np.random.random((n, 1))
+        b = np.random.random((n, 3))
+        c = np.random.random(n)
+        d = np.arange(n)
+        sql2.append_values(file=file, table=table, columns=["a_f64", "b_f64", "c", "d"], values=(a, b, c, d))
+        sql2.execute(file=file, query=f"CREATE INDEX idx_d ON {table}(d)")
+        sql2.execute(file=file, query=f"CREATE INDEX idx_dc ON {table}(c, d) WHERE d > 3")
+        sql2.execute(file=file, query=f"CREATE INDEX idx_b ON {table}(b_f64)")
+
+        sql2.rebuild_table(file=file, table=table, columns=["d", "a_f64", "b_f64", "c"], drop="b_f64",
+                           cast={"c": sql2.TYPE_INTEGER}, rename={"d": "dd"}, squeeze=True, chunk_size=7)
+
+        names, types = sql2.get_columns(file=file, table=table, mode=["name", "type"])
+        self.assertTrue(np.array_equal(names, ["dd", "a_f64", "c"]))
+        self.assertTrue(np.array_equal(types, [sql2.TYPE_INTEGER, sql2.TYPE_REAL, sql2.TYPE_INTEGER]))
+
+        dd, a2, c2 = sql2.get_values(file=file, table=table)
+        self.assertTrue(np.array_equal(d, dd))
+        self.assertTrue(np.array_equal(a[:, 0], a2))
+        self.assertTrue(np.all(c2 == 0))
+        with sql2.open_db_connection(file=file) as con:  # renamed columns are kept, dropped columns are removed
+            self.assertTrue(sorted(con.execute("SELECT sql FROM sqlite_master WHERE type='index'").fetchall()) ==
+                            [(f"CREATE INDEX idx_d ON {table}(dd)",),
+                             (f"CREATE INDEX idx_dc ON {table}(c, dd) WHERE dd > 3",)])
+        self.assertTrue("idx_d" in sql2.explain(file=file, table=table, where="dd = 3", verbose=0)[1])
+
+        sql2.execute(file=file, query="DROP INDEX idx_dc")
+        sql2.execute(file=file, query=f"CREATE INDEX idx_e ON {table}(dd + c)")  # expression, can not be recreated
+        with self.assertRaises(sqlite3.OperationalError):
+            sql2.rebuild_table(file=file, table=table, drop="c")
+        self.assertTrue(np.array_equal(sql2.get_columns(file=file, table=table, mode="name"), ["dd", "a_f64", "c"]))
+        sql2.execute(file=file, query="DROP INDEX idx_e")
+        sql2.rebuild_table(file=file, table=table, rename={"dd": "d"})
+        sql2.sort_table(file=file, table=table, order_by={"d": "DESC"})
+        self.assertTrue(np.array_equal(sql2.get_values(file=file, table=table, columns="d"), d[::-1]))
+        with sql2.open_db_connection(file=file) as con:
+            self.assertTrue(con.execute("SELECT name FROM sqlite_master WHERE type='index'").fetchall() == [("idx_d",)])
+
+    def test_rebuild_table_null(self):
+        file = f"{directory}/dummy_test_rebuild_table_null.db"
+        table = "dummytable"
+        a, b = np.random.random((5, 1)), np.arange(5)
+        sql2.append_values(file=file, table=table, columns=["a_f64", "b"], values=(a, b))
+        sql2.execute(file=file, query=f"INSERT INTO {table} (b) VALUES (5)")
+        sql2.execute(file=file, query=f"UPDATE {table} SET a_f64 = NULL WHERE b = 0")
+
+        with sql2.Database(file) as db:
+            sql2.execute(file=file, query=f"UPDATE {table} SET a_f64 = 7 WHERE b = 5")
+            with self.assertRaises(TypeError):  # mixed BLOB / INTEGER column can not be squeezed
+                sql2.rebuild_table(file=file, table=table, squeeze=True, chunk_size=2)
+            self.assertFalse(db.con.in_transaction)
+            with sql2.open_db_connection(file=file) as con:
+                tables = con.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()
+            self.assertTrue(tables == [(table,)])
+
+            sql2.execute(file=file, query=f"UPDATE {table} SET a_f64 = NULL WHERE b = 5")
+            sql2.rebuild_table(file=file, table=table, squeeze=True, chunk_size=2)
+            a = sql2.get_values(file=file, table=table, columns="a_f64")
+            self.assertTrue(np.array_equal(np.isnan(a), [True, False, False, False, False, True]))
+            self.assertTrue(sql2.get_columns(file=file, table=table, mode="type")[0] == sql2.TYPE_REAL)
+
     def test_sort_table(self):
         file = f"{directory}/dummy_test_sort_table.db"
         df = self.__create_dummy_db("C")
@@ -202,3 +741,42 @@ class Test(TestCase):
         print(data2)
         a2 = sql2.get_values(file=file, table=table, columns="A")
         self.assertTrue(np.all(np.argsort(a2) == np.arange(len(a2))))
+
+    def test_where(self):
+        file = f"{directory}/dummy_test_where.db"
+        table = "dummytable"
+        n = 1000
+        world = np.arange(n) % 20
+        m = np.random.randint(0, 10, n)
+        x = np.random.random((n, 3))
+        df = pd.DataFrame(dict(world=world, m=m, x_f64=list(x)))
+        sql2.df2sql(df=df, file=file, table=table, if_exists="replace")
+
+        b = (world == 17) & (m > 3)
+        w, x2 = sql2.get_values(file=file, table=table, columns=["world", "x_f64"],
+                                where="world = ? AND m > ?", params=(17, 3))
+        self.assertTrue(np.array_equal(w, world[b]))
+        self.assertTrue(np.array_equal(x2, x[b]))
+        self.assertTrue(np.array_equal(sql2.get_rows(file=file, table=table, where="world = ? AND m > ?",
+                                                     params=(17, 3)), np.nonzero(b)[0]))
+
+        b = np.isin(world, [3, 4])
+        rows = np.arange(100, 600)
+        m2 = sql2.get_values(file=file, table=table, columns="m", rows=rows, where={"world": [3, 4]})
+        self.assertTrue(np.array_equal(m2, m[rows][b[rows]]))
+        m2 = np.concatenate([c for c in sql2.iter_values(file=file, table=table, columns="m", chunk_size=7,
+                                                         where={"world": np.int64(5)})])
+        self.assertTrue(np.array_equal(m2, m[world == 5]))
+
+        # indices
+        self.assertTrue(sql2.list_indices(file=file, table=table) == [])
+        _, indices = sql2.explain(file=file, table=table, columns="m", where={"world": 5}, verbose=0)
+        self.assertTrue(indices == [])
+        name = sql2.create_index(file=file, table=table, columns="world")
+        self.assertTrue(sql2.list_indices(file=file, table=table) == [name])
+        _, indices = sql2.explain(file=file, table=table, columns="m", where={"world": 5}, verbose=0)
+        self.assertTrue(indices == [name])
+        self.assertTrue(np.array_equal(sql2.get_values(file=file, table=table, columns="m", where={"world": 5}),
+                                       m[world == 5]))
+        sql2.drop_index(file=file, name=name)
+        self.assertTrue(sql2.list_indices(file=file) == [])